@@ -0,0 +1,193 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+""" Headless command line interface, for scheduled backups on machines without a display.
+Never imports the GUI (PySimpleGUI) modules. Run it as `python -m backupper`. """
+
+import argparse
+import sys
+
+from .launcher              import APP_VERSION
+from .lowapi.sbt_file       import SBT_BackupReader
+from .lowapi.sbt_restore    import SBT_Restore
+from .lowapi.sbt_batch      import ACCOUNT_DB_PATH, loadAccounts, backupAccount, SBT_BatchBackup
+
+def _backend(args):
+	""" The backend class chosen with --backend. """
+	if args.backend == "async":
+		from .lowapi.sbt_asyncapi import SBT_LowAPI
+	else:
+		from .lowapi.sbt_lowapi import SBT_LowAPI
+	return SBT_LowAPI
+
+def _connect(args):
+	print(f"Connecting to account {args.client_id}...", file=sys.stderr)
+	return _backend(args)(args.client_id)
+
+def _progress(done: int, total: int, tracks: int):
+	print(f"\r{done}/{total} playlists, {tracks} tracks", end="", file=sys.stderr, flush=True)
+	if done == total:
+		print(file=sys.stderr)
+
+def cmdBackup(args) -> int:
+	lowapi = _connect(args)
+	playlist_count, track_count = backupAccount(
+		lowapi, args.output, base=args.base, workers=args.workers, progress=_progress, **_backupOptions(args)
+	)
+	print(f"Backed up {playlist_count} playlists and {track_count} tracks to {args.output}")
+	return 0
+
+def _backupOptions(args) -> dict:
+	return {
+		"prettify":    args.prettify,
+		"compression": args.compression,
+		"obfuscation": args.obfuscation if args.account_id else None
+	}
+
+def cmdBackupAll(args) -> int:
+	client_ids = args.client_ids or loadAccounts(args.accounts)
+	if not client_ids:
+		print(f"No accounts to back up, add some to {args.accounts} or pass client IDs.", file=sys.stderr)
+		return 1
+
+	batch = SBT_BatchBackup(
+		_backend(args), client_ids, args.output_dir, connections=args.connections, workers=args.workers,
+		incremental=args.incremental, **_backupOptions(args)
+	)
+	print(f"Backing up {len(batch.client_ids)} accounts to {args.output_dir}...", file=sys.stderr)
+	results = batch.run(progress=print)
+
+	failed = [result for result in results if not result.ok]
+	print(f"{len(results) - len(failed)}/{len(results)} accounts backed up.")
+	return 1 if failed else 0
+
+def _plan(args):
+	lowapi = _connect(args)
+	with SBT_BackupReader(args.file) as reader:
+		restore = SBT_Restore(lowapi, reader, workers=args.workers)
+		plan = restore.plan(remove=args.remove)
+	print(plan.summary())
+	return restore, plan
+
+def cmdDiff(args) -> int:
+	_, plan = _plan(args)
+	# Like diff(1): 1 if there are differences
+	return 0 if plan.empty else 1
+
+def cmdRestore(args) -> int:
+	restore, plan = _plan(args)
+	if plan.empty:
+		print("Nothing to restore.")
+		return 0
+	if args.dry_run:
+		return 0
+	if not args.yes:
+		if not sys.stdin.isatty():
+			print("Refusing to restore without confirmation, pass --yes.", file=sys.stderr)
+			return 1
+		if input("Apply this plan? [y/N] ").strip().lower() != "y":
+			return 1
+
+	added = restore.apply(plan)
+	print(f"Restored {added['library']} Liked Songs and {added['playlists']} playlist tracks.")
+	return 0
+
+def _verifyTracks(section: str, tracks) -> int:
+	count = 0
+	last = 0
+	for track in tracks:
+		if "id" not in track or "pos" not in track:
+			raise ValueError(f"{section}: track without an ID or position")
+		if track["pos"] <= last:
+			raise ValueError(f"{section}: tracks out of order")
+		last = track["pos"]
+		count += 1
+	return count
+
+def cmdVerify(args) -> int:
+	playlist_count = 0
+	try:
+		with SBT_BackupReader(args.file) as reader:
+			if not reader.header or "version" not in reader.header:
+				raise ValueError("missing backup header")
+			track_count = _verifyTracks("Liked Songs", reader.iterLibrary())
+			for name, playlist in reader.iterPlaylists():
+				if "id" not in playlist:
+					raise ValueError(f"{name}: playlist without an ID")
+				track_count += _verifyTracks(name, playlist["tracks"])
+				playlist_count += 1
+	except Exception as ex:
+		print(f"{args.file}: INVALID ({ex})", file=sys.stderr)
+		return 2
+
+	print(f"{args.file}: OK, {reader.compression or 'uncompressed'}, {playlist_count} playlists, {track_count} tracks")
+	return 0
+
+def buildParser() -> argparse.ArgumentParser:
+	parser = argparse.ArgumentParser(prog="backupper", description="Spotify Backup Tool - command line interface")
+	parser.add_argument("--version", action="version", version=f"%(prog)s {APP_VERSION}")
+	commands = parser.add_subparsers(dest="command", required=True)
+
+	backup = commands.add_parser("backup", help="back up an account")
+	backup.add_argument("client_id")
+	backup.add_argument("-o", "--output", required=True, help="backup file to write")
+	backup.add_argument("--base", help="previous backup, unchanged playlists are copied from it")
+	backup.set_defaults(func=cmdBackup)
+
+	backup_all = commands.add_parser("backup-all", help="back up several accounts in parallel")
+	backup_all.add_argument("client_ids", nargs="*", help=f"accounts to back up (default: all accounts in {ACCOUNT_DB_PATH})")
+	backup_all.add_argument("-o", "--output-dir", required=True, help="directory for the backups, one <client_id>.sbt per account")
+	backup_all.add_argument("--accounts", default=ACCOUNT_DB_PATH, help="account storage to read the client IDs from")
+	backup_all.add_argument("--connections", type=int, default=SBT_BatchBackup.DEF_CONNECTIONS, help="requests in flight across all accounts")
+	backup_all.add_argument("--full", dest="incremental", action="store_false", help="don't use existing backups as a base")
+	backup_all.set_defaults(func=cmdBackupAll)
+
+	for command in (backup, backup_all):
+		command.add_argument("--compression", choices=("LZMA", "GZIP"))
+		command.add_argument("--prettify", action="store_true")
+		command.add_argument("--no-account-id", dest="account_id", action="store_false", help="leave the account ID out")
+		command.add_argument("--obfuscation", choices=("None", "Simple", "Static", "Extreme"), default="Simple")
+
+	for name, func, description in (
+		("restore", cmdRestore, "restore a backup to an account"),
+		("diff", cmdDiff, "show what a restore would change"),
+	):
+		command = commands.add_parser(name, help=description)
+		command.add_argument("client_id")
+		command.add_argument("file", help="backup file")
+		command.add_argument("--remove", action="store_true", help="also remove tracks that are not in the backup")
+		command.set_defaults(func=func)
+		if name == "restore":
+			command.add_argument("-n", "--dry-run", action="store_true", help="only show the plan")
+			command.add_argument("-y", "--yes", action="store_true", help="don't ask for confirmation")
+
+	verify = commands.add_parser("verify", help="check that a backup file is readable")
+	verify.add_argument("file")
+	verify.set_defaults(func=cmdVerify)
+
+	for command in (backup, backup_all, commands.choices["restore"], commands.choices["diff"]):
+		command.add_argument("--workers", type=int, default=SBT_Restore.DEF_WORKERS, help="playlists processed concurrently")
+		command.add_argument("--backend", choices=("threads", "async"), default="threads",
+			help="threads: a thread per request, async: every request on one event loop and connection pool (default: threads)")
+	return parser
+
+def main(argv=None) -> int:
+	args = buildParser().parse_args(argv)
+	return args.func(args)
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,238 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+""" End-to-end benchmark: fetch, tree build, export and restore against synthetic accounts of several sizes.
+Each size runs in a fresh interpreter, twice: once for the timings, then again with tracemalloc, which is
+too slow to time under. `peak_kb` is the peak traced memory of each phase on its own, `peak_rss_kb`
+of the "process" entry is the peak RSS of the timed run.
+Run it from the `backupper` directory:
+    python benchmarks/e2e.py [small medium large] [-o results.json] [--baseline baseline.json] [--tolerance 0.2]
+With --baseline, exits with 1 if a phase got slower, bigger, or made more requests than the baseline allows. """
+
+from os.path import dirname, abspath, getsize, join
+from time import perf_counter
+import tracemalloc
+import subprocess
+import argparse
+import platform
+import tempfile
+import resource
+import json
+import sys
+
+BACKUPPER_DIR = dirname(dirname(abspath(__file__)))
+
+# name: SBT_FakeAccount sizes
+SIZES = {
+	"small":  {"playlists": 20,   "tracks": 2_000,   "library": 500},
+	"medium": {"playlists": 200,  "tracks": 40_000,  "library": 5_000},
+	"large":  {"playlists": 1000, "tracks": 200_000, "library": 20_000}
+}
+COMPRESSIONS = (None, "GZIP", "LZMA")
+
+# Metrics compared against the baseline. Timings, memory and output size get the tolerance, request counts must not grow.
+# Output sizes vary slightly between runs, the backup header holds the current time.
+TOLERATED = ("seconds", "peak_kb", "peak_rss_kb", "bytes")
+EXACT     = ("requests",)
+# Timing and memory differences below these are noise
+MIN_SECONDS = 0.05
+MIN_KB      = 256
+
+def peakRSS() -> int:
+	""" Peak resident set size of this process so far, in KiB. """
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# bytes on macOS, KiB everywhere else
+	return peak // 1024 if sys.platform == "darwin" else peak
+
+class Phase:
+	""" Times a block and records the requests it made and its peak traced memory. """
+
+	def __init__(self, results: dict, name: str, lowapi = None) -> None:
+		self.results = results
+		self.name = name
+		self.lowapi = lowapi
+		self.metrics = {}
+
+	def __enter__(self):
+		self._requests = self.lowapi.getTransferStats()["requests"] if self.lowapi else 0
+		if tracemalloc.is_tracing():
+			tracemalloc.reset_peak()
+			self._memory, _ = tracemalloc.get_traced_memory()
+		self._start = perf_counter()
+		return self.metrics
+
+	def __exit__(self, *exc):
+		self.metrics["seconds"] = round(perf_counter() - self._start, 4)
+		if self.lowapi:
+			self.metrics["requests"] = self.lowapi.getTransferStats()["requests"] - self._requests
+		if tracemalloc.is_tracing():
+			_, peak = tracemalloc.get_traced_memory()
+			# Memory the phase needed on top of what was already allocated
+			self.metrics["peak_kb"] = max(0, peak - self._memory) // 1024
+		self.results[self.name] = self.metrics
+
+def buildTree(fetched: dict):
+	""" The data side of SBT_MainWindow.fetchTracklist(), without the window. """
+	from gui.track_list import SBT_TrackList
+
+	tracklist = SBT_TrackList()
+	tracklist.addPlaylist("library", fetched["library"])
+	for playlist in fetched["playlists"]:
+		tracklist.addPlaylist((playlist["name"], playlist["id"], playlist["snapshot_id"]), playlist["tracks"])
+	return tracklist
+
+def exportTree(tracklist, path: str, compression: str):
+	""" SBT_MainWindow.beginExport() with everything selected. """
+	from lowapi.sbt_file import backupHeader, SBT_BackupWriter
+
+	with SBT_BackupWriter(path, backupHeader(), prettify=False, compression=compression) as writer:
+		writer.writeLibrary(tracklist.exportTracks("library", added_at=True))
+		for uid in tracklist.playlists:
+			if uid == "library":
+				continue
+			writer.writePlaylist(uid[0], {"id": uid[1], "snapshot_id": uid[2]}, tracklist.exportTracks(uid))
+
+def runPhases(size: str, seed: int, latency: float) -> dict:
+	""" Run every phase for one account size, in this process. """
+	from lowapi.sbt_fakeapi    import SBT_LowAPI, SBT_FakeAccount
+	from lowapi.sbt_ratelimit  import SBT_RateLimiter
+	from lowapi.sbt_file       import SBT_BackupReader
+	from lowapi.sbt_restore    import SBT_Restore
+
+	results = {}
+	with Phase(results, "generate") as metrics:
+		account = SBT_FakeAccount(seed, **SIZES[size])
+		metrics["tracks"] = account.trackCount + len(account.library)
+
+	# Unthrottled, so the numbers measure our code and the simulated latency only
+	limiter = SBT_RateLimiter(rate=1e6, burst=1000)
+	lowapi = SBT_LowAPI("benchmark", account=account, limiter=limiter, latency=latency)
+
+	with Phase(results, "fetch", lowapi):
+		fetched = {"playlists": lowapi.getPlaylists(), "library": lowapi.getSavedTracks()}
+
+	with Phase(results, "tree"):
+		tree = buildTree(fetched)
+	del fetched
+
+	with tempfile.TemporaryDirectory() as tmp:
+		for compression in COMPRESSIONS:
+			path = join(tmp, f"backup-{compression or 'plain'}.sbt")
+			with Phase(results, f"export_{(compression or 'plain').lower()}") as metrics:
+				exportTree(tree, path, compression)
+			metrics["bytes"] = getsize(path)
+
+		target = SBT_LowAPI("target", account=SBT_FakeAccount(seed, 0, 0, 0), limiter=limiter, latency=latency)
+		with Phase(results, "restore", target):
+			with SBT_BackupReader(join(tmp, "backup-plain.sbt")) as reader:
+				restore = SBT_Restore(target, reader)
+				restore.apply(restore.plan())
+	return results
+
+def runSize(size: str, seed: int, latency: float) -> dict:
+	""" Run every phase for one account size, timed, then again for the memory of each phase. """
+	from lowapi.sbt_fakeapi import trackID
+
+	results = runPhases(size, seed, latency)
+	rss = peakRSS()
+
+	# Start the traced run as cold as the timed one
+	trackID.cache_clear()
+	tracemalloc.start()
+	for phase, metrics in runPhases(size, seed, latency).items():
+		results[phase]["peak_kb"] = metrics["peak_kb"]
+	tracemalloc.stop()
+
+	results["process"] = {"peak_rss_kb": rss}
+	return results
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+	""" Return a line for every metric that regressed against the baseline. """
+	regressions = []
+	for size, phases in results.items():
+		for phase, metrics in phases.items():
+			previous = baseline.get(size, {}).get(phase)
+			if not previous:
+				continue
+			for metric, value in metrics.items():
+				if metric not in previous:
+					continue
+				limit = previous[metric] * (1 + tolerance) if metric in TOLERATED else previous[metric]
+				if metric == "seconds":
+					limit = max(limit, previous[metric] + MIN_SECONDS)
+				elif metric == "peak_kb":
+					limit = max(limit, previous[metric] + MIN_KB)
+				if metric in TOLERATED + EXACT and value > limit:
+					regressions.append(f"{size}/{phase}: {metric} {previous[metric]} -> {value}")
+	return regressions
+
+def main(argv=None) -> int:
+	parser = argparse.ArgumentParser(description="End-to-end benchmark against synthetic accounts.")
+	parser.add_argument("sizes", nargs="*", help=f"account sizes to run (default: {', '.join(SIZES)})")
+	parser.add_argument("-o", "--output", help="write the results to this JSON file")
+	parser.add_argument("--baseline", help="compare against the results of an earlier run")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown/growth of timings and memory (default: 0.2)")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per request (default: 0)")
+	parser.add_argument("--child", help=argparse.SUPPRESS)
+	args = parser.parse_args(argv)
+
+	if args.child:
+		sys.path.insert(0, BACKUPPER_DIR)
+		json.dump(runSize(args.child, args.seed, args.latency), sys.stdout)
+		return 0
+
+	for size in args.sizes:
+		if size not in SIZES:
+			parser.error(f"unknown size: {size}")
+
+	results = {}
+	for size in args.sizes or SIZES:
+		proc = subprocess.run(
+			[sys.executable, abspath(__file__), "--child", size, "--seed", str(args.seed), "--latency", str(args.latency)],
+			cwd=BACKUPPER_DIR, capture_output=True, text=True
+		)
+		if proc.returncode != 0:
+			print(f"{size}: failed\n{proc.stderr}", file=sys.stderr)
+			return 2
+		results[size] = json.loads(proc.stdout)
+		for phase, metrics in results[size].items():
+			print(f"{size:>6} {phase:<12} " + "  ".join(f"{metric}={value}" for metric, value in metrics.items()))
+
+	if args.output:
+		with open(args.output, "w") as file:
+			json.dump({
+				"python": platform.python_version(),
+				"platform": platform.platform(),
+				"seed": args.seed,
+				"latency": args.latency,
+				"results": results
+			}, file, indent=4)
+
+	if args.baseline:
+		with open(args.baseline, "r") as file:
+			baseline = json.load(file)["results"]
+		regressions = compare(results, baseline, args.tolerance)
+		for line in regressions:
+			print(f"REGRESSION {line}")
+		if regressions:
+			return 1
+		print("No regressions against the baseline.")
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
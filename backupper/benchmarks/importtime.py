@@ -0,0 +1,110 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+""" Cold start import-time benchmark. Imports each entry point in a fresh interpreter with `-X importtime`,
+sums the cumulative time of the top-level imports and exits with 1 if any target goes over its budget.
+Modules imported by interpreter startup alone (`site`, and whatever it pulls in) are measured with `-c pass`
+and left out, so only the app's own imports count.
+Run it from the `backupper` directory: `python benchmarks/importtime.py [--budget-ms N] [--runs N] [--top N]` """
+
+from os.path import dirname, abspath
+import subprocess
+import argparse
+import sys
+
+BACKUPPER_DIR = dirname(dirname(abspath(__file__)))
+REPO_DIR      = dirname(BACKUPPER_DIR)
+
+# name: (working directory, code to run, default budget in ms)
+TARGETS = {
+	"lowapi":   (BACKUPPER_DIR, "import lowapi.sbt_lowapi, lowapi.sbt_file, lowapi.sbt_restore", 50),
+	"cli":      (REPO_DIR,      "import backupper.__main__", 50),
+	# main_window does `from __main__ import APP_VERSION`, so provide it like launcher.py would
+	"gui":      (BACKUPPER_DIR, "APP_VERSION = 'bench'; import gui.main_window", 550)
+}
+
+# Modules which must not be imported at startup, they're loaded on first use
+DEFERRED = ("spotipy", "requests", "lzma", "gzip", "webbrowser", "importlib_metadata")
+
+def measure(cwd: str, code: str) -> dict:
+	""" Run `code` in a fresh interpreter and return {module: (self µs, cumulative µs, depth)}. """
+	proc = subprocess.run(
+		[sys.executable, "-X", "importtime", "-c", code],
+		cwd=cwd, capture_output=True, text=True
+	)
+	if proc.returncode != 0:
+		raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+	modules = {}
+	for line in proc.stderr.splitlines():
+		# import time: self [us] | cumulative | imported package
+		if not line.startswith("import time:") or "self [us]" in line:
+			continue
+		self_us, cumulative_us, name = line[len("import time:"):].split("|")
+		# Top-level imports are indented by 1 space, every level below by 2 more
+		depth = (len(name) - len(name.lstrip()) - 1) // 2
+		modules[name.strip()] = (int(self_us), int(cumulative_us), depth)
+	return modules
+
+def total(modules: dict, startup = ()) -> int:
+	""" Total import time in µs, the sum of the cumulative times of top-level imports not in `startup`. """
+	return sum(
+		cumulative for module, (_, cumulative, depth) in modules.items() if depth == 0 and module not in startup
+	)
+
+def main(argv=None) -> int:
+	parser = argparse.ArgumentParser(description="Cold start import-time benchmark.")
+	parser.add_argument("targets", nargs="*", help=f"entry points to measure (default: {', '.join(TARGETS)})")
+	parser.add_argument("--runs", type=int, default=5, help="take the best of N runs (default: 5)")
+	parser.add_argument("--budget-ms", type=float, help="override the per-target budget")
+	parser.add_argument("--top", type=int, default=5, help="show the N slowest imports (default: 5)")
+	args = parser.parse_args(argv)
+	for name in args.targets:
+		if name not in TARGETS:
+			parser.error(f"unknown target: {name}")
+
+	failed = False
+	for name in args.targets or TARGETS:
+		cwd, code, budget = TARGETS[name]
+		budget = args.budget_ms if args.budget_ms is not None else budget
+
+		try:
+			startup = set().union(*(measure(cwd, "pass") for _ in range(args.runs)))
+			runs = [measure(cwd, code) for _ in range(args.runs)]
+		except RuntimeError as e:
+			print(f"{name}: could not import ({e})")
+			failed = True
+			continue
+
+		best = min(runs, key=lambda modules: total(modules, startup))
+		elapsed = total(best, startup) / 1000
+		eager = [module for module in DEFERRED if module in best and module not in startup]
+		ok = elapsed <= budget and not eager
+		failed |= not ok
+
+		print(f"{name}: {elapsed:.1f} ms (budget {budget:g} ms) {'OK' if ok else 'FAIL'}")
+		for module in eager:
+			print(f"  {module} is imported at startup")
+		imported = {module: times for module, times in best.items() if module not in startup}
+		slowest = sorted(imported.items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+		for module, (self_us, cumulative_us, _) in slowest:
+			print(f"  {self_us / 1000:8.1f} ms self {cumulative_us / 1000:8.1f} ms cumulative  {module}")
+
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
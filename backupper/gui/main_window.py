@@ -15,24 +15,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>
 
-from importlib_metadata import version as module_version
-from os.path            import exists, expanduser
+from os.path            import expanduser, dirname, join
 from platform           import python_version
 from dataclasses        import dataclass
 from datetime           import datetime
-from random             import randrange
-from time               import sleep
+from time               import monotonic
 from enum               import auto
 
 import PySimpleGUI as sg
-import webbrowser
+import threading
 import json
-import lzma
-import gzip
 
 # SBT backend
 from .acctsetup_window import SBT_AccountSetup
 from .export_window    import SBT_ExportWizard
+from .operation_window import SBT_Operation
+from .session_pool     import SBT_SessionPool
+from .selection_model  import SBT_SelectionModel
+from .track_list       import SBT_TrackList
+from .tree_updater     import SBT_TreeUpdater
+from lowapi.sbt_file   import loadBackup, backupPlaylists, backupLibrary, backupHeader, obfuscateAccount, SBT_BackupWriter
+from lowapi.sbt_lowapi import SBT_Cancelled
+from lowapi.sbt_batch  import ACCOUNT_DB_PATH, loadAccounts
 # App version from Launcher
 from __main__           import APP_VERSION
 
@@ -43,38 +47,44 @@ sg.theme("DarkGrey")
 class PlaylistUID:
     name: str
     id: str
+    snapshot_id: str = None
+
+LIBRARY_UID = PlaylistUID("library", auto())
 
 @dataclass(frozen=True)
-class TrackUID:
+class PlaceholderUID:
+    """ Stands in for the tracks of a playlist until it is expanded. """
     playlist: PlaylistUID
-    name: str
-    album: str
-    artist: str
-    id: str
-
-LIBRARY_UID = PlaylistUID("library", auto())
 
 class SBT_MainWindow:
     SYMBOL_DOWN_ARROW = "⇩"
     SYMBOL_CHECKED    = "✅"
     SYMBOL_UNCHECKED  = "☑️"
 
-    ACCOUNT_DB_PATH = "~/sbt_accounts.json"
+    SELECTION_SYMBOLS = {
+        SBT_SelectionModel.ALL:     "✅",
+        SBT_SelectionModel.PARTIAL: "⏹",
+        SBT_SelectionModel.NONE:    "❌"
+    }
+
+    ACCOUNT_DB_PATH = ACCOUNT_DB_PATH
+    ASSET_DIR       = dirname(__file__)
 
     TDATA = sg.TreeData()
 
-    TITLE_IMAGE_COL = [[ sg.Image("gui/sbt_logo_mini.png", s=(100, 100)) ]]
+    # Images and package versions are filled in once the window is shown, see _loadTitle()
+    TITLE_IMAGE_COL = [[ sg.Image(key="logo", s=(100, 100)) ]]
     TITLE_TEXT_COL = [
         [sg.Text("Spotify Backupper Tool", font="_ 20")],
         [sg.Text(f"Version: {APP_VERSION}")],
         [sg.Text(f"Python version: {python_version()}", pad=(5, 0))],
-        [sg.Text(f"SpotiPy version: {module_version('spotipy')}", pad=(5, 0))],
-        [sg.Text(f"PySimpleGUI version: {module_version('PySimpleGUI')}", pad=(5, 0))],
+        [sg.Text("SpotiPy version: ...", key="spotipy_version", s=(30, 1), pad=(5, 0))],
+        [sg.Text("PySimpleGUI version: ...", key="psg_version", s=(30, 1), pad=(5, 0))],
         [sg.Text("Copyright (C) 2022 Fábián Varga - br0kenpixel", pad=(5, 3))]
     ]
     TITLE_GITHUB_COL = [[
         sg.Button(
-            image_filename      = "gui/github_logo.png",
+            "",
             mouseover_colors    = "darkblue",
             button_color        = "black",
             key                 = "git",
@@ -99,7 +109,11 @@ class SBT_MainWindow:
         ],
         [
             sg.Frame("Accounts", [
-                [sg.Combo([], default_value="Please select...", s=(95, 1), readonly=True, key="accounts"),
+                [sg.Combo([], default_value="Please select...", s=(84, 1), readonly=True, key="accounts"),
+                 sg.Input(key="base", visible=False),
+                 sg.FileBrowse("Base...", key="base_browse", target="base",
+                               file_types=(("SBT Backup Files", "*.sbt *.sbf"),),
+                               tooltip="Previous backup, unchanged playlists are copied from it"),
                  sg.Button(SYMBOL_DOWN_ARROW, disabled_button_color="gray", key="acct_select"),
                  sg.Button("+", key="new", disabled_button_color="gray")]
             ], key="backup"),
@@ -144,34 +158,56 @@ class SBT_MainWindow:
         *FOOTER
     ]
 
-    UNFOCUS_TARGET = ["git", "accounts", "acct_select", "new", "file", "refresh", "export"]
+    UNFOCUS_TARGET = ["git", "accounts", "base_browse", "acct_select", "new", "file", "refresh", "export"]
 
     def __init__(self, backend = None):
         self.backend = backend
+        # Connected accounts, switching back to one doesn't log in or fetch again
+        self.sessions = SBT_SessionPool(backend)
+        self.lowapi = None
         self._selected = None
+        # Running background operation, see _startOperation()
+        self.operation = None
+
+        # Playlists in display order (without Liked Songs)
+        self.playlists = []
+        # Tracks are keyed by ordinal, every playlist owns a range of them (see SBT_TrackList)
+        self.tracklist = SBT_TrackList()
+        self.selection = self.tracklist.selection
+        self.tracklist.addPlaylist(LIBRARY_UID, ())
+        # Playlists whose track rows were not created yet
+        self._collapsed = set()
         
         self.window = sg.Window("Spotify Backup Manager", self.LAYOUT, finalize=True)
         self.window['tree'].Widget.configure(show='tree')
+        self.window['tree'].bind("<<TreeviewOpen>>", "_open")
+        self.tree_updates = SBT_TreeUpdater(self.window['tree'])
         self.TDATA.insert("", LIBRARY_UID, "💿 Liked Songs", ["✅"])
         
         self.refresh()
+        self._loadTitle()
         self.loadAccounts()
         self.handle()
 
+    def _loadTitle(self):
+        """ Load title bar images and package versions, after the window was first drawn. """
+        from importlib_metadata import version as module_version
+
+        self.window["logo"].update(filename=join(self.ASSET_DIR, "sbt_logo_mini.png"))
+        self.window["git"].update(image_filename=join(self.ASSET_DIR, "github_logo.png"), image_subsample=14)
+        self.window["spotipy_version"].update(f"SpotiPy version: {module_version('spotipy')}")
+        self.window["psg_version"].update(f"PySimpleGUI version: {module_version('PySimpleGUI')}")
+        self.refresh()
+
     def loadAccounts(self):
-        if not exists(expanduser("~/sbt_accounts.json")):
-            return
-        
         try:
-            storage = open(expanduser("~/sbt_accounts.json"), "r")
-            accounts = json.load(storage)
-            assert isinstance(accounts, list), "Invalid data type found, corrupt file?"
-        except Exception:
+            accounts = loadAccounts(self.ACCOUNT_DB_PATH)
+        except Exception as ex:
             sg.popup_error_with_traceback("Error while reading account storage:", ex)
             exit(1)
 
-        self.window["accounts"].update(values=accounts, value="Please select...")
-        storage.close()
+        if accounts:
+            self.window["accounts"].update(values=accounts, value="Please select...")
 
     def saveAccounts(self):
         accounts = self.getAccounts()
@@ -179,7 +215,7 @@ class SBT_MainWindow:
             return
 
         try:
-            storage = open(expanduser("~/sbt_accounts.json"), "w")
+            storage = open(expanduser(self.ACCOUNT_DB_PATH), "w")
         except Exception as ex:
             sg.popup_error_with_traceback("Error while modifying account storage:", ex)
             exit(1)
@@ -219,46 +255,77 @@ class SBT_MainWindow:
         # Unofficial way
         return self.window["accounts"].Values
 
-    def loadTracklist(self):
-        track_count = 0
-        
-        self.setStatus("Fetching playlists...")
-        playlists = self.lowapi.getPlaylists()
-        self.setStatus("Sleeping to prevent API limits...")
-        sleep(1)
-        self.setStatus("Fetching Liked Songs...")
-        library = self.lowapi.getSavedTracks()
-
-        self.track_db = {"playlists": playlists, "library":library}
-
+    def fetchTracklist(self, base_file: str = None) -> SBT_TrackList:
+        """ Fetch playlists and Liked Songs into a new track list. Runs on a worker thread, see _startOperation(). """
+        base = None
+        library_base = None
+        if base_file:
+            self._postStatus("Reading base backup...")
+            backup = loadBackup(base_file)
+            base = backupPlaylists(backup)
+            library_base = backupLibrary(backup)
+
+        self._postStatus("Fetching playlists...")
+        playlists = self.lowapi.getPlaylists(base=base, progress=self._postProgress)
+        self._postStatus("Fetching Liked Songs...")
+        library = self.lowapi.getSavedTracks(base=library_base)
+
+        # Time of the last full Liked Songs fetch, carried over by incremental syncs
+        tracklist = SBT_TrackList(backup["sbt"]["library_synced"] if library_base else str(datetime.now()))
+        tracklist.addPlaylist(LIBRARY_UID, library)
         for playlist in playlists:
-            name = playlist["name"]
-            id = playlist["id"]
-            tracks = playlist["tracks"]
-            uid = PlaylistUID(name, id)
-
-            self.TDATA.insert("", uid, f"💿 {name}", ["✅"])
-            for i, trackinfo in enumerate(tracks):
-                #self.setStatus(f"Loading {name} - {i + 1}/{len(tracks)}")
-                display = f"{trackinfo['name']} - {trackinfo['artist']}"
-                self.TDATA.insert(
-                    uid,
-                    TrackUID(uid, trackinfo["name"], trackinfo["album"], trackinfo["artist"], trackinfo["id"]),
-                    f"♫ {display}",
-                    ["✅"])
-                track_count += 1
-        
-        for i, trackinfo in enumerate(library):
-            #self.setStatus(f"Loading Liked Songs - {i + 1}/unknown")
-            display = f"{trackinfo['name']} - {trackinfo['artist']}"
-            self.TDATA.insert(
-                LIBRARY_UID,
-                TrackUID(LIBRARY_UID, trackinfo["name"], trackinfo["album"], trackinfo["artist"], trackinfo["id"]),
-                f"♫ {display}",
-                ["✅"])
-            track_count += 1
+            tracklist.addPlaylist(PlaylistUID(playlist["name"], playlist["id"], playlist["snapshot_id"]), playlist["tracks"])
+        return tracklist
+
+    def _tracklistFetched(self, tracklist: SBT_TrackList):
+        self.sessions.setTracklist(self.lowapi.client_id, tracklist)
+        self.loadTracklist(tracklist)
+
+    def _fetchTracklist(self, base_file: str = None):
+        self._startOperation("Loading tracks...", self.fetchTracklist, base_file, on_done=self._tracklistFetched)
+
+    def loadTracklist(self, tracklist: SBT_TrackList):
+        """ Show a track list with its selection, see fetchTracklist(). """
+        self.tracklist = tracklist
+        self.selection = tracklist.selection
+        self.library_synced = tracklist.library_synced
+        self.playlists = [uid for uid in tracklist.playlists if uid != LIBRARY_UID]
+
+        # Only playlist rows are created here, track rows are created when a playlist is expanded
+        self.TDATA = sg.TreeData()
+        self._collapsed = set()
+        for uid in tracklist.playlists:
+            self._insertPlaylist(uid, "💿 Liked Songs" if uid == LIBRARY_UID else f"💿 {uid.name}")
+
+        self.tree_updates.clear()
         self.updateElement("tree", values=self.TDATA)
-        self.setStatus(f"Ready. Retrieved {track_count} tracks.")
+        self.setStatus(f"Ready. Retrieved {len(tracklist.track_refs)} tracks.")
+
+    def _insertPlaylist(self, uid, text: str):
+        self.TDATA.insert("", uid, text, [self.SELECTION_SYMBOLS[self.selection.state(uid)]])
+        if len(self.selection.tracks(uid)) != 0:
+            # Gives the row an expand arrow
+            self.TDATA.insert(uid, PlaceholderUID(uid), "...", [""])
+            self._collapsed.add(uid)
+
+    def _expandPlaylists(self):
+        """ Create the track rows of playlists that were just expanded. """
+        tree = self.window["tree"]
+        expanded = [uid for uid in self._collapsed if tree.Widget.item(tree.KeyToID[uid], "open")]
+
+        for uid in expanded:
+            self._collapsed.discard(uid)
+            parent = tree.KeyToID[uid]
+            placeholder = tree.KeyToID.pop(PlaceholderUID(uid))
+            del tree.IdToKey[placeholder]
+            tree.Widget.delete(placeholder)
+
+            for ordinal in self.selection.tracks(uid):
+                track = self.tracklist.track(ordinal)
+                mode = "✅" if self.selection.isSelected(ordinal) else "❌"
+                row = tree.Widget.insert(parent, "end", text=f"♫ {track.name} - {track.artist}", values=[mode])
+                tree.KeyToID[ordinal] = row
+                tree.IdToKey[row] = ordinal
 
     # Alias
     def refresh(self):
@@ -273,149 +340,173 @@ class SBT_MainWindow:
 
     def _getItemSelection(self, uid):
         """ Return the selection state of an item. """
-        return self.TDATA.tree_dict[uid].values[0] in ("✅", "⏹")
+        if isinstance(uid, PlaylistUID):
+            return self.selection.state(uid) != SBT_SelectionModel.NONE
+        return self.selection.isSelected(uid)
 
     def _setItemSelection(self, uid, mode):
-        self.window["tree"].update(key=uid, value=[mode])
-        self.TDATA.tree_dict[uid].values = [mode]
+        self.tree_updates.queue(uid, [mode])
+        if uid in self.TDATA.tree_dict:
+            self.TDATA.tree_dict[uid].values = [mode]
 
     def _findPlaylistTracks(self, playlist_uid):
-        """ Yield tracks from the specified playlist. """
-        for entry in self.TDATA.tree_dict.keys():
-            if isinstance(entry, TrackUID):
-                if entry.playlist == playlist_uid:
-                    yield entry
-
-    def _getPlaylistTrackSelections(self, playlist_uid):
-        """ Yield selection modes for every track in a playlist. """
-        for track_uid in self._findPlaylistTracks(playlist_uid):
-            yield self._getItemSelection(track_uid)
-
-    def _checkPlaylistSelection(self, playlist_uid):
-        """ Check if all tracks in the specified playlist have the same selection mode. """
-        modes = self._getPlaylistTrackSelections(playlist_uid)
-        first = next(modes)
-        return all(mode == first for mode in modes)
+        """ Return the ordinals of the tracks in the specified playlist. """
+        return self.selection.tracks(playlist_uid)
 
     def setPlaylistTrackSelection(self, playlist_uid, mode):
-        """ Set selection mode for all tracks in the specified playlist. """
+        """ Show the selection mode on every track row of the specified playlist. """
+        if playlist_uid in self._collapsed:
+            # No track rows yet, they are created from the selection model
+            return
         for track in self._findPlaylistTracks(playlist_uid):
-            self.TDATA.tree_dict[track].values[0] = mode
-            self.window["tree"].update(key=track, value=[mode])
+            self.tree_updates.queue(track, [mode])
 
     def changeSelection(self, uid):
-        current_mode = self.TDATA.tree_dict[uid].values[0]
-        mode = "✅" if current_mode == "❌" else "❌"
-
-        self._setItemSelection(uid, mode)
+        if isinstance(uid, PlaceholderUID):
+            return
 
         if isinstance(uid, PlaylistUID):
             # Clicked on a playlist
             # Change selection for every track
-            self.setPlaylistTrackSelection(uid, mode)
+            selected = self.selection.state(uid) == SBT_SelectionModel.NONE
+            self.selection.setPlaylist(uid, selected)
+            self.setPlaylistTrackSelection(uid, self.SELECTION_SYMBOLS[self.selection.state(uid)])
+            playlist = uid
         else:
             # Clicked on a track
-            playlist = uid.playlist
+            playlist = self.selection.playlistOf(uid)
+            selected = not self.selection.isSelected(uid)
+            self.selection.setTrack(playlist, uid, selected)
+            self._setItemSelection(uid, "✅" if selected else "❌")
 
-            if self._checkPlaylistSelection(playlist):
-                self.setPlaylistTrackSelection(playlist, mode)
-            else:
-                mode = "⏹"
-            self._setItemSelection(playlist, mode)
+        self._setItemSelection(playlist, self.SELECTION_SYMBOLS[self.selection.state(playlist)])
 
     def _getPlaylists(self):
         """ Yield all playlists. """
-        for entry in self.TDATA.tree_dict.keys():
-            if isinstance(entry, PlaylistUID) and entry != LIBRARY_UID:
-                yield entry
+        yield from self.playlists
 
     def _includeLibrary(self):
         return self._getItemSelection(LIBRARY_UID)
 
     def _obfuscated_account(self, mode):
-        acct = list(self.lowapi.id)
-
-        if mode == "Simple":
-            for _ in range(6):
-                pos = randrange(0, len(acct))
-                acct[pos] = "*"
-        elif mode == "Static":
-            sums = tuple(map(int, acct))
-            sums = zip(sums[::2], sums[1::2])
-            sums = map(sum, sums)
-            positions = map(lambda n: n % len(acct), set(sums))
-
-            for pos in positions:
-                acct[pos] = "*"
-        elif mode == "Extreme":
-            skip = (0, len(acct) - 1, len(acct) // 2)
-            for pos in range(len(acct)):
-                if pos not in skip:
-                    acct[pos] = "*"
-        return "".join(acct)
+        return obfuscateAccount(self.lowapi.id, mode)
+
+    def _exportTracks(self, playlist_uid, added_at: bool = False):
+        """ Yield export records for the selected tracks of a playlist. """
+        return self.tracklist.exportTracks(playlist_uid, added_at)
 
     def beginExport(self, opts: dict):
-        self.setStatus("Exporting selected songs... Please wait!")
-
-        time_info = datetime.now()      
-        save_data = {
-            "sbt": {
-                "version": 2.0,
-                "creation": str(time_info),
-                "account": self._obfuscated_account(opts["account_obfuscation"]) if opts["account_id"] else None
-            },
-            "library": None,
-            "playlists": None
-        }
+        """ Write the selected songs to a backup file. Runs on a worker thread, see _startOperation(). """
+        self._postStatus("Exporting selected songs... Please wait!")
+
+        header = backupHeader(self._obfuscated_account(opts["account_obfuscation"]) if opts["account_id"] else None)
 
+        library = None
         if self._includeLibrary():
-            save_data["library"] = []
-            for i, track in enumerate(self._findPlaylistTracks(LIBRARY_UID)):
-                if self._getItemSelection(track):
-                    save_data["library"].append({
-                        "pos": i + 1,
-                        "name": track.name,
-                        "album": track.album,
-                        "artist": track.artist,
-                        "id": track.id
-                    })
-
-        for playlist in self._getPlaylists():
-            if self._getItemSelection(playlist):
-                if save_data["playlists"] == None:
-                    save_data["playlists"] = {}
-                save_data["playlists"][playlist.name] = {"id": playlist.id, "tracks": []}
-            for i, track in enumerate(self._findPlaylistTracks(playlist)):
-                if self._getItemSelection(track):
-                    save_data["playlists"][playlist.name]["tracks"].append({
-                        "pos": i + 1,
-                        "name": track.name,
-                        "album": track.album,
-                        "artist": track.artist,
-                        "id": track.id
-                    })
-        
-        save_data = json.dumps(save_data, indent=(4 if opts["prettify"] else 0)).encode()
-        if opts["compress"]:
-            if opts["compression"] == "LZMA":
-                save_data = lzma.compress(save_data)
-            elif opts["compression"] == "GZIP":
-                save_data = gzip.compress(save_data)
-
-        savef = open(opts["file"], "wb")
-        savef.write(save_data)
-        savef.flush()
-        savef.close()
-        self.setStatus("Export successful.")
+            library = self._exportTracks(LIBRARY_UID, added_at=True)
+            if self.selection.state(LIBRARY_UID) == SBT_SelectionModel.ALL:
+                # Only a complete library can be the base of an incremental sync
+                header["library_synced"] = self.library_synced
+
+        playlists = [playlist for playlist in self._getPlaylists() if self._getItemSelection(playlist)]
+        track_count = 0
+        compression = opts["compression"] if opts["compress"] else None
+        with SBT_BackupWriter(opts["file"], header, prettify=opts["prettify"], compression=compression) as writer:
+            writer.writeLibrary(library)
+            for i, playlist in enumerate(playlists):
+                if self.lowapi.cancelled.is_set():
+                    # Leaving the writer discards the partial file
+                    raise SBT_Cancelled()
+                info = {"id": playlist.id, "snapshot_id": playlist.snapshot_id}
+                writer.writePlaylist(playlist.name, info, self._exportTracks(playlist))
+                track_count += self.selection.selectedCount(playlist)
+                self._postProgress(i + 1, len(playlists), track_count)
+
+    def _postStatus(self, msg: str):
+        """ Thread-safe setStatus(), also shown in the operation window. """
+        self.window.write_event_value("op_message", msg)
+
+    def _postProgress(self, done: int, total: int, tracks: int):
+        self.window.write_event_value("op_progress", (done, total, tracks))
+
+    def _runOperation(self, job, args):
+        try:
+            result = job(*args)
+        except SBT_Cancelled:
+            self.window.write_event_value("op_cancelled", None)
+        except Exception as ex:
+            self.window.write_event_value("op_error", ex)
+        else:
+            self.window.write_event_value("op_done", result)
+
+    def _startOperation(self, msg: str, job, *args, on_done = None, done_msg: str = "Ready"):
+        """ Run `job(*args)` on a worker thread behind a progress window.
+        `on_done(result)` is called on the GUI thread once it finishes. """
+        for element in self.UNFOCUS_TARGET:
+            self.updateElement(element, disabled=True)
+        self.setStatus(msg)
+
+        self.lowapi.cancelled.clear()
+        self.operation = SBT_Operation(msg)
+        self._operation_done = (on_done, done_msg)
+        self._operation_started = monotonic()
+        threading.Thread(target=self._runOperation, args=(job, args), daemon=True).start()
+
+    def _showProgress(self, done: int, total: int, tracks: int):
+        elapsed = monotonic() - self._operation_started
+        detail = f"{done}/{total} playlists, {tracks / elapsed if elapsed else 0:.0f} tracks/s"
+        if 0 < done < total:
+            eta = elapsed / done * (total - done)
+            detail += f", ETA {int(eta // 60)}:{int(eta % 60):02d}"
+        self.operation.setProgress(done, max(total, 1))
+        self.operation.setDetail(detail)
+
+    def _finishOperation(self, event, result):
+        self.operation.close()
+        self.operation = None
+        for element in self.UNFOCUS_TARGET:
+            self.updateElement(element, disabled=False)
+
+        on_done, done_msg = self._operation_done
+        if event == "op_done":
+            self.setStatus(done_msg)
+            if on_done:
+                on_done(result)
+        elif event == "op_cancelled":
+            self.setStatus("Cancelled.")
+        else:
+            self.setStatus("Operation failed.")
+            sg.popup_error_with_traceback("Error while running operation:", result)
 
     def handle(self):
         while True:
-            event, values = self.window.read()
+            # Apply the tree changes of the previous event in one go
+            self.tree_updates.flush()
+            # Wake up regularly while an operation runs, so its window stays responsive
+            event, values = self.window.read(timeout=100 if self.operation else None)
             #print(event, values)
             if event == sg.WIN_CLOSED:
+                if self.operation:
+                    self.lowapi.cancelled.set()
                 break
 
+            if self.operation:
+                self.operation.poll()
+                if self.operation.cancelled:
+                    self.lowapi.cancelled.set()
+
+            if event == "op_message":
+                self.setStatus(values[event])
+                self.operation.setMessage(values[event])
+
+            if event == "op_progress":
+                self._showProgress(*values[event])
+
+            if event in ("op_done", "op_cancelled", "op_error"):
+                self._finishOperation(event, values[event])
+
             if event == "git":
+                import webbrowser
                 webbrowser.open("https://github.com/br0kenpixel")
 
             if event == "new":
@@ -440,19 +531,30 @@ class SBT_MainWindow:
                     self.updateElement(element, disabled=True)
                 try:
                     client_id = values["accounts"].split(" ", 1)[0] # Filter out name if present
-                    self.setStatus(f"Connecting to account {client_id}...")
-                    self.lowapi = self.backend(client_id)
+                    if client_id not in self.sessions:
+                        self.setStatus(f"Connecting to account {client_id}...")
+                    self.lowapi = self.sessions.get(client_id)
                 except Exception as ex:
                     sg.popup_error_with_traceback("Error while setting up backend:", ex)
                     break
 
-                self.updateElement("accounts", value=f"{values['accounts']} - {self.lowapi.display_name}")
-                self.setStatus("Loading tracks...")
-                self.loadTracklist()
-                for element in self.UNFOCUS_TARGET:
-                    self.updateElement(element, disabled=False)
+                self.updateElement("accounts", value=f"{client_id} - {self.lowapi.display_name}")
+                tracklist = self.sessions.tracklist(client_id)
+                if tracklist is None:
+                    self._fetchTracklist(values["base"] or None)
+                else:
+                    self.loadTracklist(tracklist)
+                    for element in self.UNFOCUS_TARGET:
+                        self.updateElement(element, disabled=False)
+
+            if event == "refresh" and self.lowapi:
+                self._fetchTracklist(values["base"] or None)
+
+            if event == "tree_open":
+                self._expandPlaylists()
+                self.tree_updates.expanded()
 
-            if event == "tree":
+            if event == "tree" and not self.operation:
                 selection = values["tree"][0]
                 if self._selected == selection:
                     self.changeSelection(selection)
@@ -469,11 +571,9 @@ class SBT_MainWindow:
                 opts = wizard.start()
 
                 # Do the export here...
-                self.beginExport(opts)
-
-                for element in self.UNFOCUS_TARGET:
-                    self.window[element].update(disabled=False)
+                self._startOperation("Exporting selected songs...", self.beginExport, opts, done_msg="Export successful.")
 
+        self.sessions.close()
         self.window.close()
 
 if __name__ == "__main__":
@@ -17,35 +17,62 @@
 
 import PySimpleGUI as sg
 import threading
-from copy import deepcopy
 
 class SBT_Operation:
+	""" Progress window for a long running operation.
+
+	The window doesn't block, its owner updates it and calls `poll()` from its own event loop.
+	`cancelled` is set once the user clicks Cancel or closes the window. """
+
 	def __init__(self, msg: str = "Pending operation...", pbMax: int = 100):
 		layout = [
-			[sg.Column([[sg.Text(msg, key="msg", font="_ 12", justification="c")]], vertical_alignment='center', justification='center',  k='-C-')],
+			[sg.Column([[sg.Text(msg, key="msg", font="_ 12", justification="c", s=(40, 1))]], vertical_alignment='center', justification='center',  k='-C-')],
 			[sg.Sizer(0, 5)],
-			[sg.ProgressBar(pbMax, s=(40, 15), key="bar")]
+			[sg.ProgressBar(pbMax, s=(40, 15), key="bar")],
+			[sg.Text("", key="detail", s=(50, 1))],
+			[sg.Push(), sg.Button("Cancel", key="cancel", disabled_button_color="gray")]
 		]
+		self.pbMax = pbMax
 		self.window = sg.Window("Spotify Backup Manager - Operation", layout, finalize=True)
 		self.stopEvent = threading.Event()
-		self.handle()
 
-	def setProgress(self, n: int):
-		pass
+	@property
+	def cancelled(self) -> bool:
+		return self.stopEvent.is_set()
+
+	def setProgress(self, n: int, pbMax: int = None):
+		if pbMax is not None:
+			self.pbMax = pbMax
+		self.window["bar"].update(current_count=n, max=self.pbMax)
 
 	def setMessage(self, msg: str):
-		pass
+		self.window["msg"].update(msg)
+
+	def setDetail(self, msg: str):
+		self.window["detail"].update(msg)
+
+	def poll(self):
+		""" Process pending events of the window without blocking. """
+		if self.window.was_closed():
+			return
+		event, values = self.window.read(timeout=0)
+		if event in (sg.WIN_CLOSED, "cancel"):
+			self.stopEvent.set()
+			if event == "cancel":
+				self.setMessage("Cancelling...")
+				self.window["cancel"].update(disabled=True)
 
 	def close(self):
 		self.stopEvent.set()
+		self.window.close()
 
 	def handle(self):
-		while not self.stopEvent.isSet():
+		while not self.stopEvent.is_set():
 			event, values = self.window.read()
-			if event == sg.WIN_CLOSED:
+			if event in (sg.WIN_CLOSED, "cancel"):
 				self.stopEvent.set()
 				break
 		self.window.close()
 
 if __name__ == "__main__":
-	SBT_Operation("Processing...", 100)
\ No newline at end of file
+	SBT_Operation("Processing...", 100).handle()
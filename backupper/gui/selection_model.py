@@ -0,0 +1,89 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+from bisect import bisect_right
+
+class SBT_SelectionModel:
+	""" Selection state of every track, kept apart from the tree widget.
+
+	Tracks are numbered by ordinal and every playlist owns a contiguous range of ordinals,
+	so selecting a whole playlist is a single slice assignment. Selected tracks are counted
+	per playlist, which makes the playlist's tri-state check a constant time comparison. """
+
+	NONE    = 0
+	PARTIAL = 1
+	ALL     = 2
+
+	def __init__(self):
+		self._selected = bytearray()
+		self._ranges = dict()
+		self._counts = dict()
+		# Selection of empty playlists, which have no tracks to count
+		self._checked = dict()
+		# First ordinal of every playlist, in ordinal order, to find the owner of a track
+		self._starts = list()
+		self._order = list()
+
+	def __repr__(self):
+		return f"<SBT_SelectionModel playlists={len(self._ranges)} tracks={len(self._selected)}>"
+
+	def addPlaylist(self, playlist, size: int, selected: bool = True) -> range:
+		""" Register a playlist with `size` tracks, returns the ordinals of its tracks. """
+		start = len(self._selected)
+		self._selected.extend((b"\x01" if selected else b"\x00") * size)
+		self._ranges[playlist] = range(start, start + size)
+		self._counts[playlist] = size if selected else 0
+		self._checked[playlist] = selected
+		self._starts.append(start)
+		self._order.append(playlist)
+		return self._ranges[playlist]
+
+	def playlistOf(self, ordinal: int):
+		""" Return the playlist a track belongs to. """
+		return self._order[bisect_right(self._starts, ordinal) - 1]
+
+	def tracks(self, playlist) -> range:
+		return self._ranges[playlist]
+
+	def isSelected(self, ordinal: int) -> bool:
+		return self._selected[ordinal] == 1
+
+	def selectedCount(self, playlist) -> int:
+		return self._counts[playlist]
+
+	def state(self, playlist) -> int:
+		""" Return NONE, PARTIAL or ALL. """
+		size = len(self._ranges[playlist])
+		count = self._counts[playlist]
+		if size == 0:
+			return self.ALL if self._checked[playlist] else self.NONE
+		if count == 0:
+			return self.NONE
+		return self.ALL if count == size else self.PARTIAL
+
+	def setTrack(self, playlist, ordinal: int, selected: bool):
+		assert ordinal in self._ranges[playlist], "Track is not part of the playlist"
+		if self._selected[ordinal] != selected:
+			self._selected[ordinal] = selected
+			self._counts[playlist] += 1 if selected else -1
+
+	def setPlaylist(self, playlist, selected: bool):
+		""" Select or deselect every track of a playlist. """
+		tracks = self._ranges[playlist]
+		self._selected[tracks.start:tracks.stop] = (b"\x01" if selected else b"\x00") * len(tracks)
+		self._counts[playlist] = len(tracks) if selected else 0
+		self._checked[playlist] = selected
@@ -0,0 +1,84 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+# system + builtin
+from collections import OrderedDict
+
+class SBT_SessionPool:
+	""" Live backend sessions, keyed by client ID.
+
+	A session keeps its authorized client, token, user profile and playlist index, so switching
+	back to an account repeats neither the login nor the profile request. The track list last fetched
+	for an account (an SBT_TrackList, with its selection) is kept with its session. Once there are more than `size` sessions, the least
+	recently used one is closed. """
+
+	DEF_SIZE = 8
+
+	def __init__(self, backend, size: int = DEF_SIZE) -> None:
+		""" `backend` is the backend class, called with the client ID to open a session. """
+		self.backend = backend
+		self.size = max(1, size)
+		# client ID -> [backend, track list], least recently used first
+		self._sessions = OrderedDict()
+
+	def __repr__(self):
+		return f"<SBT_SessionPool sessions={len(self._sessions)}/{self.size}>"
+
+	def __contains__(self, client_id: str) -> bool:
+		return client_id in self._sessions
+
+	def __len__(self) -> int:
+		return len(self._sessions)
+
+	def get(self, client_id: str):
+		""" Return the session of `client_id`, connecting (and authorizing) it if there is none. """
+		if client_id in self._sessions:
+			self._sessions.move_to_end(client_id)
+			return self._sessions[client_id][0]
+
+		lowapi = self.backend(client_id)
+		self._sessions[client_id] = [lowapi, None]
+		while len(self._sessions) > self.size:
+			_, (evicted, _) = self._sessions.popitem(last=False)
+			self._close(evicted)
+		return lowapi
+
+	def tracklist(self, client_id: str):
+		""" Return the track list last fetched for `client_id`, or None. """
+		session = self._sessions.get(client_id)
+		return session[1] if session else None
+
+	def setTracklist(self, client_id: str, tracklist):
+		if client_id in self._sessions:
+			self._sessions[client_id][1] = tracklist
+
+	def drop(self, client_id: str):
+		""" Close the session of `client_id`, the next get() connects again. """
+		session = self._sessions.pop(client_id, None)
+		if session:
+			self._close(session[0])
+
+	def close(self):
+		while self._sessions:
+			_, (lowapi, _) = self._sessions.popitem()
+			self._close(lowapi)
+
+	@staticmethod
+	def _close(lowapi):
+		# Only the async backend holds a connection pool
+		if hasattr(lowapi, "close"):
+			lowapi.close()
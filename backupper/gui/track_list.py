@@ -0,0 +1,70 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+from array import array
+from sys   import intern
+
+from .selection_model import SBT_SelectionModel
+from .track_table     import SBT_TrackTable, SBT_Track
+
+class SBT_TrackList:
+	""" The tracks shown in the main window and their selection, without any widgets.
+
+	Tracks are keyed by ordinal (see SBT_SelectionModel). Every ordinal refers to a unique
+	track in an SBT_TrackTable and keeps when it was added to its playlist.
+	`library_synced` is the time of the last full Liked Songs fetch (see sbt_file.backupHeader). """
+
+	def __init__(self, library_synced: str = None):
+		self.library_synced = library_synced
+		# Playlists in the order they were added
+		self.playlists = []
+		self.selection = SBT_SelectionModel()
+		self.tracks = SBT_TrackTable()
+		self.track_refs = array("I")
+		self.track_added = []
+
+	def __repr__(self):
+		return f"<SBT_TrackList tracks={len(self.track_refs)} unique={len(self.tracks)}>"
+
+	def addPlaylist(self, uid, tracks) -> range:
+		""" Add a playlist with its tracks as returned by the backend, all selected.
+		Returns the ordinals of its tracks. """
+		ordinals = self.selection.addPlaylist(uid, len(tracks))
+		self.playlists.append(uid)
+		for trackinfo in tracks:
+			self.track_refs.append(self.tracks.add(trackinfo))
+			self.track_added.append(intern(trackinfo["added_at"]) if trackinfo["added_at"] else None)
+		return ordinals
+
+	def track(self, ordinal: int) -> SBT_Track:
+		return self.tracks[self.track_refs[ordinal]]
+
+	def exportTracks(self, uid, added_at: bool = False):
+		""" Yield export records for the selected tracks of a playlist. """
+		for i, ordinal in enumerate(self.selection.tracks(uid)):
+			if self.selection.isSelected(ordinal):
+				track = self.track(ordinal)
+				record = {
+					"pos": i + 1,
+					"name": track.name,
+					"album": track.album,
+					"artist": track.artist,
+					"id": track.id
+				}
+				if added_at:
+					record["added_at"] = self.track_added[ordinal]
+				yield record
@@ -0,0 +1,67 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+from sys import intern
+
+class SBT_Track:
+	""" A unique track, shared by all of its occurrences in playlists. """
+	__slots__ = ("id", "name", "album", "artist")
+
+	def __init__(self, id: str, name: str, album: str, artist: str):
+		self.id = id
+		self.name = name
+		self.album = album
+		self.artist = artist
+
+	def __repr__(self):
+		return f"<SBT_Track id={self.id} name=\"{self.name}\">"
+
+class SBT_TrackTable:
+	""" Stores every unique track once, with interned strings.
+	Tracks are referred to by their integer position in the table. """
+
+	def __init__(self):
+		self._tracks = list()
+		self._refs = dict()
+
+	def __repr__(self):
+		return f"<SBT_TrackTable tracks={len(self._tracks)}>"
+
+	def __len__(self):
+		return len(self._tracks)
+
+	def __getitem__(self, ref: int) -> SBT_Track:
+		return self._tracks[ref]
+
+	@staticmethod
+	def _intern(value):
+		return intern(value) if value else value
+
+	def add(self, trackinfo: dict) -> int:
+		""" Return the reference of a track, adding it to the table if it's new. """
+		# Local files have no ID
+		key = trackinfo["id"] or (trackinfo["name"], trackinfo["album"], trackinfo["artist"])
+		ref = self._refs.get(key)
+		if ref is None:
+			ref = self._refs[key] = len(self._tracks)
+			self._tracks.append(SBT_Track(
+				self._intern(trackinfo["id"]),
+				self._intern(trackinfo["name"]),
+				self._intern(trackinfo["album"]),
+				self._intern(trackinfo["artist"])
+			))
+		return ref
@@ -0,0 +1,62 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+class SBT_TreeUpdater:
+	""" Coalesces row value changes of a sg.Tree and applies them to the ttk Treeview in one pass.
+
+	Changes are queued during an event and flushed once per event loop iteration, later changes
+	to the same row replace earlier ones. Rows inside collapsed parents are not touched until
+	their parent is expanded (see `expanded()`). """
+
+	def __init__(self, element):
+		self.element = element
+		self._pending = dict()
+		# Parent row ID -> {row ID: values} for rows hidden in collapsed parents
+		self._deferred = dict()
+
+	def __repr__(self):
+		return f"<SBT_TreeUpdater pending={len(self._pending)} deferred={len(self._deferred)}>"
+
+	def queue(self, key, values: list):
+		self._pending[key] = values
+
+	def clear(self):
+		""" Drop every queued change, e.g. before the whole tree is re-rendered. """
+		self._pending.clear()
+		self._deferred.clear()
+
+	def flush(self):
+		if not self._pending:
+			return
+		widget = self.element.Widget
+		for key, values in self._pending.items():
+			row = self.element.KeyToID.get(key)
+			if row is None:
+				continue
+			parent = widget.parent(row)
+			if parent and not widget.item(parent, "open"):
+				self._deferred.setdefault(parent, dict())[row] = values
+			else:
+				widget.item(row, values=values)
+		self._pending.clear()
+
+	def expanded(self):
+		""" Apply deferred changes of every parent that is expanded now. """
+		widget = self.element.Widget
+		for parent in [parent for parent in self._deferred if widget.item(parent, "open")]:
+			for row, values in self._deferred.pop(parent).items():
+				widget.item(row, values=values)
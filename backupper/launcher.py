@@ -19,5 +19,9 @@ APP_VERSION = "2.0"
 
 if __name__ == '__main__':
 	from gui.main_window import SBT_MainWindow
-	from lowapi import sbt_lowapi as sbt_lowapi
+	import sys
+	if "--async" in sys.argv[1:]:
+		from lowapi import sbt_asyncapi as sbt_lowapi
+	else:
+		from lowapi import sbt_lowapi as sbt_lowapi
 	SBT_MainWindow(sbt_lowapi.SBT_LowAPI)
\ No newline at end of file
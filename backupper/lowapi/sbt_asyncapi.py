@@ -0,0 +1,536 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+# system + builtin
+from os.path import expanduser
+from time    import time
+import threading
+import asyncio
+
+# SBT backend
+from .sbt_ratelimit import SBT_RateLimiter
+from .sbt_lowapi    import (
+	SBT_Cancelled, SBT_PlaylistIndex, SBT_LibraryMerge, trackInfo, playlistInfo, createdPlaylist, applyBase, batches, tokenCache
+)
+from .sbt_lowapi    import SBT_LowAPI as SBT_SyncLowAPI
+
+API_URL = "https://api.spotify.com/v1"
+
+class SBT_AsyncLowAPI:
+	""" Asyncio counterpart of SBT_LowAPI. Every request goes through one pooled keep-alive HTTP client,
+	so hundreds of requests can be in flight on a single thread.
+
+	The iteration methods (`iterPlaylists`, `iterPlaylistTracks`, `iterSavedTracks`) are async generators,
+	everything else is a coroutine. Call `connect()` (or use `async with`) before making requests. """
+
+	DEF_REDIRECT_URI     = SBT_SyncLowAPI.DEF_REDIRECT_URI
+	DEF_SCOPES           = SBT_SyncLowAPI.DEF_SCOPES
+	MAX_RETRIES          = SBT_SyncLowAPI.MAX_RETRIES
+	PAGE_LIMITS          = SBT_SyncLowAPI.PAGE_LIMITS
+	WRITE_LIMITS         = SBT_SyncLowAPI.WRITE_LIMITS
+	PLAYLIST_ITEM_FIELDS = SBT_SyncLowAPI.PLAYLIST_ITEM_FIELDS
+	DEF_MARKET           = SBT_SyncLowAPI.DEF_MARKET
+	TOKEN_CACHE_PATH     = SBT_SyncLowAPI.TOKEN_CACHE_PATH
+	DEF_WORKERS          = 32	# playlists fetched concurrently
+	DEF_CONNECTIONS      = 64	# requests in flight, and size of the connection pool
+	TIMEOUT              = 30.0
+	# Refresh the token this many seconds before it expires
+	TOKEN_MARGIN         = 60
+	# How often to retry a `connections` semaphore shared with threads
+	SHARED_POLL          = 0.01
+
+	def __init__(self, client_id: str, redirect_uri=DEF_REDIRECT_URI, limiter: SBT_RateLimiter = None,
+			connections = None) -> None:
+		""" `limiter` is the rate limit budget of this backend, it can be shared with other (sync or async) backends.
+		`connections` is the number of requests in flight, or a threading.Semaphore shared with other backends. """
+		self.client_id = client_id
+		self.redirect_uri = redirect_uri
+		self.limiter = limiter or SBT_RateLimiter()
+		if connections is None or isinstance(connections, int):
+			self.max_connections = connections or self.DEF_CONNECTIONS
+			self._shared = None
+		else:
+			self.max_connections = self.DEF_CONNECTIONS
+			self._shared = connections
+
+		self.auth_manager = None
+		self.http = None
+		self.usercache = None
+		self._token = None
+		self._expires = 0.0
+		# Created in connect(), they belong to the running event loop
+		self._token_lock = None
+		self._connections = None
+		self._index_lock = None
+
+		self._stats = {"requests": 0, "bytes": 0}
+		# Set from any thread to abort the running operation
+		self.cancelled = threading.Event()
+
+		# Built on first lookup
+		self._playlist_index = None
+
+	def __repr__(self):
+		return f"<SBT_AsyncLowAPI user=\"{self.display_name if self.usercache else None}\">"
+
+	async def __aenter__(self):
+		await self.connect()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def connect(self):
+		""" Open the connection pool, authorize and load the user profile. """
+		# external - imported here so that importing the backend stays cheap
+		from spotipy.oauth2 import SpotifyPKCE
+		import httpx
+
+		self._token_lock = asyncio.Lock()
+		self._connections = asyncio.Semaphore(self.max_connections)
+		self._index_lock = asyncio.Lock()
+		self.auth_manager = SpotifyPKCE(
+			client_id=self.client_id,
+			redirect_uri=self.redirect_uri,
+			scope=" ".join(self.DEF_SCOPES),
+			cache_handler=tokenCache(self.client_id, expanduser(self.TOKEN_CACHE_PATH.format(client_id=self.client_id)))
+		)
+		self.http = httpx.AsyncClient(
+			base_url=API_URL,
+			timeout=self.TIMEOUT,
+			limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+		)
+		# Trigger auth
+		self.usercache = await self._request("GET", "/me")
+
+	async def close(self):
+		if self.http is not None:
+			await self.http.aclose()
+			self.http = None
+
+	@property
+	def display_name(self) -> str:
+		return self.usercache["display_name"]
+
+	@property
+	def id(self) -> str:
+		return self.usercache["id"]
+
+	@property
+	def user_url(self) -> str:
+		return self.usercache["external_urls"]["spotify"]
+
+	@property
+	def user_followers(self) -> int:
+		return self.usercache["followers"]["total"]
+
+	@property
+	def user_picture(self) -> str:
+		return self.usercache["images"][0]["url"]
+
+	def getTransferStats(self) -> dict:
+		""" Return the number of responses and (decompressed) bytes received so far. """
+		stats = dict(self._stats)
+		stats["bytes_per_request"] = stats["bytes"] / stats["requests"] if stats["requests"] else 0
+		return stats
+
+	async def _accessToken(self, expired: str = None) -> str:
+		""" Return a valid access token. It is refreshed once and shared by every request waiting on it.
+		`expired` is a token the API rejected, it's refreshed even if it isn't due yet. """
+		async with self._token_lock:
+			if self._token is None or self._token == expired or time() > self._expires - self.TOKEN_MARGIN:
+				if self._token is not None:
+					# Make spotipy refresh instead of handing back its cached token
+					token_info = self.auth_manager.cache_handler.get_cached_token()
+					if token_info:
+						token_info["expires_at"] = 0
+						self.auth_manager.cache_handler.save_token_to_cache(token_info)
+				# Blocking (and the first time interactive), keep it off the event loop
+				self._token = await asyncio.to_thread(self.auth_manager.get_access_token)
+				token_info = self.auth_manager.cache_handler.get_cached_token() or {}
+				self._expires = token_info.get("expires_at", time() + 3600)
+			return self._token
+
+	async def _acquireConnection(self):
+		if self._shared is not None:
+			# Shared with threads, poll it instead of blocking the event loop
+			while not self._shared.acquire(blocking=False):
+				await asyncio.sleep(self.SHARED_POLL)
+		try:
+			await self._connections.acquire()
+		except BaseException:
+			if self._shared is not None:
+				self._shared.release()
+			raise
+
+	def _releaseConnection(self):
+		self._connections.release()
+		if self._shared is not None:
+			self._shared.release()
+
+	async def _request(self, method: str, path: str, *, params: dict = None, body: dict = None):
+		""" Send one API request through the rate limiter and the connection pool.
+		Throttled (429) and failed (5xx) requests are retried honoring Retry-After, like SBT_LowAPI does.
+		A POST (adding playlist items, creating a playlist) may have been applied when it times out or fails
+		with 5xx, those errors are raised instead of sending it again. Errors are raised as spotipy.SpotifyException and requests exceptions, like the threaded backend raises them. """
+		import requests
+		import spotipy
+		import httpx
+
+		idempotent = method != "POST"
+		for attempt in range(self.MAX_RETRIES + 1):
+			await self.limiter.acquireAsync()
+			if self.cancelled.is_set():
+				raise SBT_Cancelled()
+			token = await self._accessToken()
+			await self._acquireConnection()
+			try:
+				response = await self.http.request(
+					method, path, params=params, json=body, headers={"Authorization": f"Bearer {token}"}
+				)
+			except httpx.TransportError as ex:
+				if attempt == self.MAX_RETRIES or not idempotent:
+					error = requests.Timeout if isinstance(ex, httpx.TimeoutException) else requests.ConnectionError
+					raise error(str(ex)) from ex
+				self.limiter.throttled()
+				continue
+			finally:
+				self._releaseConnection()
+
+			self._stats["requests"] += 1
+			self._stats["bytes"] += len(response.content)
+			if response.status_code == 401 and attempt < self.MAX_RETRIES:
+				await self._accessToken(expired=token)
+				continue
+			if (response.status_code == 429 or (idempotent and response.status_code >= 500)) and attempt < self.MAX_RETRIES:
+				retry_after = response.headers.get("Retry-After")
+				self.limiter.throttled(float(retry_after) if retry_after else None)
+				continue
+			if response.is_error:
+				raise self._error(response)
+			self.limiter.success()
+			return response.json() if response.content else None
+
+	@staticmethod
+	def _error(response):
+		""" Convert an error response to the exception spotipy would raise for it. """
+		import spotipy
+
+		try:
+			message = response.json()["error"]["message"]
+		except (ValueError, KeyError, TypeError):
+			message = "error"
+		return spotipy.SpotifyException(
+			response.status_code, -1, f"{response.url}:\n {message}", reason=response.reason_phrase,
+			headers=dict(response.headers)
+		)
+
+	async def _getPagedItem(self, path: str, endpoint: str, *, limit: int = None, fanout: bool = False, **params):
+		""" Yield every item of a paged endpoint, see SBT_LowAPI.__getPagedItem().
+		With `fanout`, all remaining pages are requested at once and yielded back in order. """
+		max_limit = self.PAGE_LIMITS[endpoint]
+		params["limit"] = min(limit, max_limit) if limit else max_limit
+		data = await self._request("GET", path, params=params)
+		for item in data["items"]:
+			yield item
+
+		offset = data.get("offset", 0) + len(data["items"])
+		if fanout and data.get("total") is not None and data.get("limit"):
+			pages = [
+				asyncio.ensure_future(self._request("GET", path, params={**params, "offset": page_offset}))
+				for page_offset in range(offset, data["total"], data["limit"])
+			]
+			try:
+				for page in pages:
+					for item in (await page)["items"]:
+						yield item
+			finally:
+				for page in pages:
+					page.cancel()
+			return
+
+		while data.get("next") and len(data["items"]) != 0:
+			data = await self._request("GET", path, params={**params, "offset": offset})
+			for item in data["items"]:
+				yield item
+			offset += len(data["items"])
+
+	async def iterPlaylists(self, *, limit: int = None):
+		async for playlist in self._getPagedItem("/me/playlists", "playlists", limit=limit):
+			info = playlistInfo(playlist)
+			info["tracks"] = self.iterPlaylistTracks(info["id"])
+			yield info
+
+	async def iterPlaylistNames(self):
+		async for playlist in self._getPagedItem("/me/playlists", "playlists"):
+			yield playlist["name"]
+
+	async def iterPlaylistTracks(self, playlist_id: str, *, limit: int = None, fanout: bool = False):
+		getter = self._getPagedItem(
+			f"/playlists/{playlist_id}/tracks",
+			"playlist_items",
+			fanout = fanout,
+			fields = self.PLAYLIST_ITEM_FIELDS,
+			market = self.DEF_MARKET,
+			additional_types = "track",
+			limit = limit
+		)
+		async for item in getter:
+			yield trackInfo(item)
+
+	async def iterSavedTracks(self, *, limit: int = None, fanout: bool = False):
+		getter = self._getPagedItem("/me/tracks", "saved_tracks", fanout=fanout, market=self.DEF_MARKET, limit=limit)
+		async for item in getter:
+			yield trackInfo(item)
+
+	async def getPlaylistTracks(self, playlist_id: str) -> tuple:
+		return tuple([track async for track in self.iterPlaylistTracks(playlist_id, fanout=True)])
+
+	async def getPlaylists(self, workers: int = DEF_WORKERS, base: dict = None, progress = None) -> tuple:
+		""" Fetch every playlist with its tracks, `workers` playlists at a time. See SBT_LowAPI.getPlaylists(). """
+		playlists = tuple([playlist async for playlist in self.iterPlaylists()])
+		async with self._index_lock:
+			self._playlist_index = SBT_PlaylistIndex(playlists)
+
+		changed, track_count = applyBase(playlists, base)
+		done = len(playlists) - len(changed)
+		if progress:
+			progress(done, len(playlists), track_count)
+
+		running = asyncio.Semaphore(max(1, workers))
+		async def fetch(playlist):
+			nonlocal done, track_count
+			async with running:
+				playlist["tracks"] = await self.getPlaylistTracks(playlist["id"])
+			done += 1
+			track_count += len(playlist["tracks"])
+			if progress:
+				progress(done, len(playlists), track_count)
+
+		await asyncio.gather(*(fetch(playlist) for playlist in changed))
+		return playlists
+
+	async def _playlistIndex(self) -> SBT_PlaylistIndex:
+		""" Return the playlist index, listing the account's playlists once if needed. """
+		async with self._index_lock:
+			if self._playlist_index is None:
+				self._playlist_index = SBT_PlaylistIndex([playlist async for playlist in self.iterPlaylists()])
+			return self._playlist_index
+
+	def invalidatePlaylistIndex(self):
+		""" Drop the playlist index, it will be rebuilt on the next lookup. """
+		self._playlist_index = None
+
+	async def getPlaylistNames(self):
+		return (await self._playlistIndex()).names()
+
+	async def getPlaylistIDs(self, playlist_name, owner: str = None) -> tuple:
+		""" Return the IDs of every playlist called `playlist_name`, only those owned by `owner` if given. """
+		return (await self._playlistIndex()).ids(playlist_name, owner)
+
+	async def getPlaylistID(self, playlist_name):
+		ids = await self.getPlaylistIDs(playlist_name)
+		if len(ids) == 0:
+			raise Exception("Could not find playlist")
+		return ids[0]
+
+	async def getPlaylistInfo(self, playlist_id) -> dict:
+		return (await self._playlistIndex()).info(playlist_id)
+
+	async def createPlaylist(self, name: str, public: bool = False, description: str = "") -> str:
+		""" Create a new playlist and return its ID. """
+		playlist = await self._request(
+			"POST", f"/users/{self.id}/playlists",
+			body={"name": name, "public": public, "collaborative": False, "description": description}
+		)
+		if self._playlist_index is not None:
+			self._playlist_index.add(createdPlaylist(playlist, name, self.id))
+		return playlist["id"]
+
+	async def renamePlaylist(self, playlist_id: str, name: str):
+		await self._request("PUT", f"/playlists/{playlist_id}", body={"name": name})
+		if self._playlist_index is not None and not self._playlist_index.rename(playlist_id, name):
+			# Not ours or not indexed yet, rebuild on the next lookup
+			self._playlist_index = None
+
+	async def addPlaylistTracks(self, playlist_id: str, track_ids):
+		""" Append tracks to a playlist, in order, as few requests as possible. See SBT_LowAPI.addPlaylistTracks(). """
+		for batch in batches(track_ids, self.WRITE_LIMITS["playlist_add"]):
+			await self._request(
+				"POST", f"/playlists/{playlist_id}/tracks", body={"uris": [f"spotify:track:{id_}" for id_ in batch]}
+			)
+
+	async def saveTracks(self, track_ids):
+		""" Add tracks to Liked Songs, pass the oldest tracks first. See SBT_LowAPI.saveTracks(). """
+		for batch in batches(track_ids, self.WRITE_LIMITS["library_save"]):
+			await self._request("PUT", "/me/tracks", body={"ids": batch[::-1]})
+
+	async def removePlaylistTracks(self, playlist_id: str, track_ids):
+		""" Remove every occurrence of the given tracks from a playlist. """
+		# Batches of a playlist don't depend on each other, remove them concurrently
+		await asyncio.gather(*(
+			self._request(
+				"DELETE", f"/playlists/{playlist_id}/tracks",
+				body={"tracks": [{"uri": f"spotify:track:{id_}"} for id_ in batch]}
+			)
+			for batch in batches(track_ids, self.WRITE_LIMITS["playlist_remove"])
+		))
+
+	async def unsaveTracks(self, track_ids):
+		""" Remove tracks from Liked Songs. """
+		await asyncio.gather(*(
+			self._request("DELETE", "/me/tracks", body={"ids": batch})
+			for batch in batches(track_ids, self.WRITE_LIMITS["library_remove"])
+		))
+
+	async def getSavedTracks(self, base: list = None) -> tuple:
+		""" Fetch Liked Songs, newest first. See SBT_LowAPI.getSavedTracks(). """
+		if not base:
+			return tuple([track async for track in self.iterSavedTracks(fanout=True)])
+
+		merge = SBT_LibraryMerge(base)
+		async for track in self.iterSavedTracks():
+			if not merge.add(track):
+				break
+		return merge.result()
+
+# Every synchronous front end runs its coroutines on this loop, in a background thread
+_loop = None
+_loop_lock = threading.Lock()
+
+def eventLoop() -> asyncio.AbstractEventLoop:
+	""" Return the shared background event loop, starting it on first use. """
+	global _loop
+	with _loop_lock:
+		if _loop is None:
+			_loop = asyncio.new_event_loop()
+			threading.Thread(target=_loop.run_forever, name="sbt-asyncio", daemon=True).start()
+		return _loop
+
+class SBT_LowAPI:
+	""" Drop-in replacement for sbt_lowapi.SBT_LowAPI backed by SBT_AsyncLowAPI, for the GUI and the CLI.
+	Calls block the calling thread like the threaded backend's do, but the requests behind them
+	all run on one shared event loop instead of a thread per playlist or page. """
+
+	DEF_REDIRECT_URI = SBT_AsyncLowAPI.DEF_REDIRECT_URI
+	DEF_WORKERS      = SBT_AsyncLowAPI.DEF_WORKERS
+
+	def __init__(self, client_id: str, redirect_uri=DEF_REDIRECT_URI, limiter: SBT_RateLimiter = None,
+			connections = None) -> None:
+		self.client_id = client_id
+		self.api = SBT_AsyncLowAPI(client_id, redirect_uri, limiter=limiter, connections=connections)
+		self.limiter = self.api.limiter
+		self.cancelled = self.api.cancelled
+		self._run(self.api.connect())
+
+	def __repr__(self):
+		return f"<SBT_LowAPI async user=\"{self.display_name}\">"
+
+	@staticmethod
+	def _run(coroutine):
+		return asyncio.run_coroutine_threadsafe(coroutine, eventLoop()).result()
+
+	def _iterate(self, generator):
+		""" Iterate an async generator of the backend from this thread. """
+		try:
+			while True:
+				try:
+					yield self._run(generator.__anext__())
+				except StopAsyncIteration:
+					return
+		finally:
+			self._run(generator.aclose())
+
+	def close(self):
+		""" Close the connection pool. """
+		self._run(self.api.close())
+
+	usercache      = property(lambda self: self.api.usercache)
+	display_name   = property(lambda self: self.api.display_name)
+	id             = property(lambda self: self.api.id)
+	user_url       = property(lambda self: self.api.user_url)
+	user_followers = property(lambda self: self.api.user_followers)
+	user_picture   = property(lambda self: self.api.user_picture)
+
+	def getTransferStats(self) -> dict:
+		return self.api.getTransferStats()
+
+	def iterPlaylists(self, *, limit: int = None):
+		for playlist in self._iterate(self.api.iterPlaylists(limit=limit)):
+			playlist["tracks"] = self.iterPlaylistTracks(playlist["id"])
+			yield playlist
+
+	def iterPlaylistNames(self):
+		return self._iterate(self.api.iterPlaylistNames())
+
+	def iterPlaylistTracks(self, playlist_id: str, *, limit: int = None, fanout: bool = False):
+		return self._iterate(self.api.iterPlaylistTracks(playlist_id, limit=limit, fanout=fanout))
+
+	def iterSavedTracks(self, *, limit: int = None, fanout: bool = False):
+		return self._iterate(self.api.iterSavedTracks(limit=limit, fanout=fanout))
+
+	def getPlaylistTracks(self, playlist_id: str) -> tuple:
+		return self._run(self.api.getPlaylistTracks(playlist_id))
+
+	def getPlaylists(self, workers: int = DEF_WORKERS, base: dict = None, progress = None) -> tuple:
+		return self._run(self.api.getPlaylists(workers, base, progress))
+
+	def invalidatePlaylistIndex(self):
+		self.api.invalidatePlaylistIndex()
+
+	def getPlaylistNames(self):
+		return self._run(self.api.getPlaylistNames())
+
+	def getPlaylistIDs(self, playlist_name, owner: str = None) -> tuple:
+		return self._run(self.api.getPlaylistIDs(playlist_name, owner))
+
+	def getPlaylistID(self, playlist_name):
+		return self._run(self.api.getPlaylistID(playlist_name))
+
+	def getPlaylistInfo(self, playlist_id) -> dict:
+		return self._run(self.api.getPlaylistInfo(playlist_id))
+
+	def createPlaylist(self, name: str, public: bool = False, description: str = "") -> str:
+		return self._run(self.api.createPlaylist(name, public, description))
+
+	def renamePlaylist(self, playlist_id: str, name: str):
+		self._run(self.api.renamePlaylist(playlist_id, name))
+
+	def addPlaylistTracks(self, playlist_id: str, track_ids):
+		self._run(self.api.addPlaylistTracks(playlist_id, track_ids))
+
+	def saveTracks(self, track_ids):
+		self._run(self.api.saveTracks(track_ids))
+
+	def removePlaylistTracks(self, playlist_id: str, track_ids):
+		self._run(self.api.removePlaylistTracks(playlist_id, track_ids))
+
+	def unsaveTracks(self, track_ids):
+		self._run(self.api.unsaveTracks(track_ids))
+
+	def getSavedTracks(self, base: list = None) -> tuple:
+		return self._run(self.api.getSavedTracks(base))
+
+
+if __name__ == "__main__":
+	# For debugging only!
+	async def main():
+		async with SBT_AsyncLowAPI("YOUR_CLIENT_ID") as sbt:
+			print(sbt)
+			async for playlist in sbt.iterPlaylists():
+				print(playlist["name"])
+	asyncio.run(main())
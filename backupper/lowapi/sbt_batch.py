@@ -0,0 +1,156 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+# system + builtin
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses        import dataclass
+from datetime           import datetime
+from os.path            import exists, expanduser, join
+from time               import monotonic
+import threading
+import json
+
+# SBT backend
+from .sbt_ratelimit import SBT_RateLimiter
+from .sbt_file      import (
+	loadBackup, backupPlaylists, backupLibrary, backupHeader, obfuscateAccount, trackRecord, SBT_BackupWriter
+)
+
+ACCOUNT_DB_PATH = "~/sbt_accounts.json"
+
+def loadAccounts(path: str = ACCOUNT_DB_PATH) -> list:
+	""" Return the client IDs stored in the account storage, or an empty list if there is none. """
+	path = expanduser(path)
+	if not exists(path):
+		return []
+	with open(path, "r") as storage:
+		accounts = json.load(storage)
+	assert isinstance(accounts, list), "Invalid data type found, corrupt file?"
+	return accounts
+
+def backupAccount(lowapi, path: str, *, base: str = None, workers: int = 4, prettify: bool = False,
+		compression: str = None, obfuscation: str = None, progress = None) -> tuple:
+	""" Back up the account behind `lowapi` to `path`, reusing unchanged playlists from the `base` backup.
+	The account ID is stored obfuscated with `obfuscation`, or left out if it's None.
+	Returns the number of playlists and tracks written. """
+	backup = None
+	playlist_base = None
+	library_base = None
+	if base:
+		backup = loadBackup(base)
+		playlist_base = backupPlaylists(backup)
+		library_base = backupLibrary(backup)
+
+	playlists = lowapi.getPlaylists(workers=workers, base=playlist_base, progress=progress)
+	library = lowapi.getSavedTracks(base=library_base)
+	# Time of the last full Liked Songs fetch, carried over by incremental syncs
+	library_synced = backup["sbt"]["library_synced"] if library_base is not None else str(datetime.now())
+
+	account = obfuscateAccount(lowapi.id, obfuscation) if obfuscation else None
+	header = backupHeader(account, library_synced)
+	with SBT_BackupWriter(path, header, prettify=prettify, compression=compression) as writer:
+		writer.writeLibrary(trackRecord(i + 1, track, added_at=True) for i, track in enumerate(library))
+		for playlist in playlists:
+			info = {"id": playlist["id"], "snapshot_id": playlist["snapshot_id"]}
+			writer.writePlaylist(playlist["name"], info, (trackRecord(i + 1, track) for i, track in enumerate(playlist["tracks"])))
+
+	return len(playlists), len(library) + sum(len(playlist["tracks"]) for playlist in playlists)
+
+@dataclass
+class SBT_BatchResult:
+	""" Outcome of backing up one account. """
+	client_id: str
+	path: str
+	playlists: int = 0
+	tracks: int = 0
+	requests: int = 0
+	seconds: float = 0.0
+	error: str = None
+
+	@property
+	def ok(self) -> bool:
+		return self.error is None
+
+	def __str__(self):
+		if not self.ok:
+			return f"{self.client_id}: FAILED after {self.seconds:.1f}s ({self.error})"
+		return f"{self.client_id}: {self.playlists} playlists, {self.tracks} tracks, {self.requests} requests in {self.seconds:.1f}s -> {self.path}"
+
+class SBT_BatchBackup:
+	""" Backs up several accounts in one run, each one to `<output_dir>/<client_id>.sbt`.
+
+	Every account runs on its own worker with its own rate limiter, so the run takes about as long
+	as the slowest account. The `connections` semaphore is shared by all backends and bounds
+	the number of requests in flight across accounts.
+	An existing backup of an account is used as the base of an incremental backup.
+	A failing account is reported in its result and doesn't affect the others. """
+
+	DEF_CONNECTIONS = 16
+
+	def __init__(self, backend, client_ids: list, output_dir: str, *, connections: int = DEF_CONNECTIONS,
+			workers: int = 4, rate: float = SBT_RateLimiter.DEF_RATE, incremental: bool = True, **options) -> None:
+		""" `backend` is the backend class (SBT_LowAPI). `options` are passed on to `backupAccount()`. """
+		self.backend = backend
+		self.client_ids = list(dict.fromkeys(client_ids))
+		self.output_dir = output_dir
+		self.connections = threading.BoundedSemaphore(max(1, connections))
+		self.workers = workers
+		self.rate = rate
+		self.incremental = incremental
+		self.options = options
+		# Spotify's login flow listens on a fixed port, so accounts are authorized one at a time
+		self._auth_lock = threading.Lock()
+
+	def __repr__(self):
+		return f"<SBT_BatchBackup accounts={len(self.client_ids)}>"
+
+	def path(self, client_id: str) -> str:
+		return join(self.output_dir, f"{client_id}.sbt")
+
+	def _connect(self, client_id: str):
+		with self._auth_lock:
+			return self.backend(client_id, limiter=SBT_RateLimiter(self.rate), connections=self.connections)
+
+	def _backup(self, client_id: str) -> SBT_BatchResult:
+		result = SBT_BatchResult(client_id, self.path(client_id))
+		start = monotonic()
+		try:
+			lowapi = self._connect(client_id)
+			base = result.path if self.incremental and exists(result.path) else None
+			result.playlists, result.tracks = backupAccount(
+				lowapi, result.path, base=base, workers=self.workers, **self.options
+			)
+			result.requests = lowapi.getTransferStats()["requests"]
+		except Exception as ex:
+			result.error = f"{type(ex).__name__}: {ex}"
+		result.seconds = monotonic() - start
+		return result
+
+	def run(self, progress = None) -> list:
+		""" Back up all accounts and return their results, in the order of `client_ids`.
+		`progress(result)` is called as each account finishes. """
+		if not self.client_ids:
+			return []
+		results = {}
+		with ThreadPoolExecutor(max_workers=len(self.client_ids)) as pool:
+			futures = [pool.submit(self._backup, client_id) for client_id in self.client_ids]
+			for future in as_completed(futures):
+				result = future.result()
+				results[result.client_id] = result
+				if progress:
+					progress(result)
+		return [results[client_id] for client_id in self.client_ids]
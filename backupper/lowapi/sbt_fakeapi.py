@@ -1,162 +1,386 @@
-class SBT_LowAPI:
-	""" Fake backend for testing the GUI. """
-
-	DEF_REDIRECT_URI = "http://localhost:8888/callback"
-	DEF_SCOPES       = [
-		"user-modify-playback-state",
-		"user-library-read",
-		"user-library-modify",
-		"playlist-modify-private",
-		"playlist-read-private",
-		"playlist-modify-public"
-	]
-
-	FAKE_PLAYLISTS = [
-		{
-			"name": "Classics",
-			"id": "1234567890",
-			"tracks": [
-				{
-					"name": "Never Gonna Give You Up",
-					"id": "1111111111"
-				},
-				{
-					"name": "Together Forever",
-					"id": "1111111112"
-				},
-				{
-					"name": "Why?",
-					"id": "1111111113"
-				},
-				{
-					"name": "Just Debugging",
-					"id": "1111111114"
-				}
-			]
-		},
-		{
-			"name": "Car songs",
-			"id": "1234567891",
-			"tracks": [
-				{
-					"name": "Shiny new car?!",
-					"id": "1111111121"
-				},
-				{
-					"name": "Hey??",
-					"id": "1111111122"
-				},
-				{
-					"name": "Need a new car",
-					"id": "1111111123"
-				},
-				{
-					"name": "Hello there!",
-					"id": "1111111124"
-				}
-			]
-		}
-	]
-
-	LIBRARY = [
-		{
-			"name": "Somewhere to Run",
-			"id": "1234567892"
-		},
-		{
-			"name": "zer0",
-			"id": "1234567893"
-		},
-		{
-			"name": "Circles",
-			"id": "1234567894"
-		},
-		{
-			"name": "No Regrets",
-			"id": "1234567895"
+# system + builtin
+from datetime import datetime, timedelta, timezone
+from collections import Counter
+from functools import lru_cache
+from array import array
+from time import monotonic, sleep
+import threading
+import random
+import json
+
+# SBT backend
+from . import sbt_lowapi
+
+BASE62    = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+ID_SPACE  = 62 ** 22
+# Odd and not a multiple of 31, so multiplying by it is a bijection on the ID space
+ID_FACTOR = 0x9E3779B97F4A7C15F39CC0605CEDC835
+CATALOGUE = 10 ** 7
+EPOCH     = datetime(2015, 1, 1, tzinfo=timezone.utc)
+
+@lru_cache(maxsize=2 ** 18)
+def trackID(index: int) -> str:
+	""" Spotify-like (22 characters, base62) ID of the synthetic track `index`.
+	Track IDs don't depend on the account, so accounts share tracks like real ones do. """
+	value = index * ID_FACTOR % ID_SPACE
+	digits = []
+	for _ in range(22):
+		value, digit = divmod(value, 62)
+		digits.append(BASE62[digit])
+	return "".join(reversed(digits))
+
+def trackIndex(track_id: str) -> int:
+	""" Inverse of trackID(), raises ValueError for IDs that aren't synthetic tracks. """
+	track_id = track_id.rsplit(":", 1)[-1].rsplit("/", 1)[-1]
+	value = 0
+	for char in track_id:
+		if char not in BASE62:
+			raise ValueError(f"Invalid track ID: {track_id}")
+		value = value * 62 + BASE62.index(char)
+	index = value * pow(ID_FACTOR, -1, ID_SPACE) % ID_SPACE
+	if len(track_id) != 22 or index >= CATALOGUE:
+		raise ValueError(f"Invalid track ID: {track_id}")
+	return index
+
+def timestamp(seconds: float) -> str:
+	""" added_at of something added `seconds` after EPOCH. """
+	return (EPOCH + timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def now() -> float:
+	return (datetime.now(timezone.utc) - EPOCH).total_seconds()
+
+class SBT_FakeAccount:
+	""" Seeded synthetic account. The same seed and sizes always produce the same account.
+
+	`tracks` is the number of playlist entries over all playlists, playlist sizes follow a
+	long-tailed distribution. `duplicate_rate` is the share of playlist and library entries
+	that reuse a track the account already has (in another playlist, the library, or the same playlist).
+	Liked Songs never hold the same track twice, like on Spotify. Without playlists, `tracks` is ignored.
+	Tracks are stored as indexes into a catalogue shared by all accounts, see trackID(). """
+
+	DEF_PLAYLISTS      = 10
+	DEF_TRACKS         = 500
+	DEF_LIBRARY        = 200
+	DEF_DUPLICATE_RATE = 0.3
+
+	def __init__(self, seed = 0, playlists: int = DEF_PLAYLISTS, tracks: int = DEF_TRACKS,
+			library: int = DEF_LIBRARY, duplicate_rate: float = DEF_DUPLICATE_RATE) -> None:
+		rng = random.Random(seed)
+		self.seed = seed
+		self.lock = threading.Lock()
+		self.user = {
+			"id": str(rng.randrange(10 ** 9, 10 ** 10)),
+			"display_name": "Eggs Benedict",
+			"external_urls": {"spotify": "https://spotify.com/"},
+			"followers": {"total": 69},
+			"images": [{"url": "https://spotify.com/"}]
 		}
-	]
 
-	def __init__(self, client_id: str, redirect_uri=DEF_REDIRECT_URI) -> None:
-		self.client_id = client_id
-		self.auth_manager = None
-		self.spotify = None
+		used = array("I")
+		def draw():
+			if used and rng.random() < duplicate_rate:
+				return used[rng.randrange(len(used))]
+			index = rng.randrange(CATALOGUE)
+			used.append(index)
+			return index
+
+		weights = [rng.lognormvariate(0, 1.2) for _ in range(playlists)]
+		scale = tracks / sum(weights) if weights else 0
+		sizes = [int(weight * scale) for weight in weights]
+		for i in range(tracks - sum(sizes) if playlists else 0):
+			sizes[i % playlists] += 1
 
-		# Trigger auth
-		self.usercache = None
+		# {"id", "name", "version", "tracks": array of track indexes, "added": array of times}
+		# Followed playlists of other users also have an "owner" (user ID)
+		self.playlists = []
+		for i, size in enumerate(sizes):
+			created = rng.uniform(0, 2.5e8)
+			self.playlists.append({
+				"id": f"{rng.getrandbits(128):032x}"[:22],
+				"name": f"Playlist {i + 1}",
+				"version": 1,
+				"tracks": array("I", (draw() for _ in range(size))),
+				"added": array("d", (created + pos * 3600 for pos in range(size)))
+			})
+
+		# Oldest first, the API serves it newest first
+		self.library = array("I")
+		saved = set()
+		for _ in range(library):
+			index = draw()
+			while index in saved:
+				index = rng.randrange(CATALOGUE)
+			saved.add(index)
+			self.library.append(index)
+		self.library_added = array("d", sorted(rng.uniform(0, 2.5e8) for _ in range(library)))
 
 	def __repr__(self):
-		return f"<SBT_FakeAPI user=\"Eggs Benedict\">"
+		return f"<SBT_FakeAccount seed={self.seed!r} playlists={len(self.playlists)} tracks={self.trackCount}>"
 
 	@property
-	def display_name(self):
-		return "Eggs Benedict"
+	def trackCount(self) -> int:
+		return sum(len(playlist["tracks"]) for playlist in self.playlists)
 
-	@property
-	def id(self):
-		return "1234567890"
+	@staticmethod
+	def track(index: int) -> dict:
+		""" Track object of the synthetic track `index`, with the fields the backend requests. """
+		return {
+			"id": trackID(index),
+			"name": f"Track {index}",
+			"album": {"name": f"Album {index // 12}"},
+			"artists": [{"name": f"Artist {index // 40}"}]
+		}
 
-	@property
-	def user_url(self):
-		return "https://spotify.com/"
+class SBT_FakeSpotify:
+	""" Stands in for spotipy.Spotify, serving an SBT_FakeAccount.
 
-	@property
-	def user_followers(self):
-		return 69
+	Every request waits `latency` seconds (±50%) and counts towards the call statistics.
+	Page and batch limits are enforced like the Web API does. If `rate_limit` is set, more than `rate_limit`
+	requests in a rolling `window` of seconds are answered with 429 and a Retry-After header.
+	`error_rate` is the share of requests failing with a 5xx error. """
 
-	@property
-	def user_picture(self):
-		return "https://spotify.com/"
-
-	def iterPlaylists(self, *, limit: int = 1):
-		for playlist in self.FAKE_PLAYLISTS:
-			name = playlist["name"]
-			id_ = playlist["id"]
-			tracks = self.iterPlaylistTracks(id_)
-
-			yield {"name": name, "id": id_, "tracks": tracks}
-
-	def iterPlaylistTracks(self, playlist_id: str, *, limit: int = 1):
-		playlist = next(playlist for playlist in self.FAKE_PLAYLISTS if playlist["id"] == playlist_id)
-		yield from playlist["tracks"]
-
-	def getPlaylistTracks(self, playlist_id: str) -> tuple:
-		results = list()
-		for result in self.iterPlaylistTracks(playlist_id, limit=100):
-			results.append(result)
-		return tuple(results)
-
-	def getPlaylists(self, delay: int = 1) -> tuple:
-		playlists = list()
-		for playlist in self.iterPlaylists(limit=50):
-			playlist["tracks"] = self.getPlaylistTracks(playlist["id"])
-			playlists.append(playlist)
-		return tuple(playlists)
-
-	def iterSavedTracks(self, *, limit: int = 1):
-		getter = self.LIBRARY
-
-		for track in getter:
-			id_ = track["track"]["id"]
-			name = track["track"]["name"]
-			#explicit = track["track"]["explicit"]
-			#duration = track["track"]["duration_ms"]
-
-			yield {
-				"id": id_,
+	DEF_LATENCY = 0.0
+	DEF_WINDOW  = 30.0
+
+	def __init__(self, account: SBT_FakeAccount, *, latency: float = DEF_LATENCY, rate_limit: int = None,
+			window: float = DEF_WINDOW, error_rate: float = 0.0, seed = 0) -> None:
+		self.account = account
+		self.latency = latency
+		self.rate_limit = rate_limit
+		self.window = window
+		self.error_rate = error_rate
+		self._rng = random.Random(seed)
+		self._recent = []
+		self._lock = threading.Lock()
+		self.calls = Counter()
+		self.stats = Counter()
+
+	def __request(self, endpoint: str, result_func):
+		""" Simulate one round trip: throttling, errors, latency, then build the response. """
+		import spotipy
+
+		with self._lock:
+			self.calls[endpoint] += 1
+			self.stats["requests"] += 1
+			clock = monotonic()
+			self._recent = [sent for sent in self._recent if sent > clock - self.window]
+			throttled = self.rate_limit is not None and len(self._recent) >= self.rate_limit
+			failed = not throttled and self._rng.random() < self.error_rate
+			if throttled:
+				retry_after = max(1, round(self._recent[0] + self.window - clock))
+			else:
+				self._recent.append(clock)
+			latency = self.latency * self._rng.uniform(0.5, 1.5)
+		sleep(latency)
+
+		if throttled:
+			with self._lock:
+				self.stats["throttled"] += 1
+			raise spotipy.SpotifyException(429, -1, "API rate limit exceeded", headers={"Retry-After": str(retry_after)})
+		if failed:
+			with self._lock:
+				self.stats["errors"] += 1
+			raise spotipy.SpotifyException(503, -1, "Service unavailable", headers={})
+
+		with self.account.lock:
+			result = result_func()
+		size = len(json.dumps(result))
+		with self._lock:
+			self.stats["bytes"] += size
+		return result
+
+	@staticmethod
+	def __checkLimit(count: int, maximum: int):
+		import spotipy
+
+		if count > maximum:
+			raise spotipy.SpotifyException(400, -1, f"Invalid limit, at most {maximum} allowed", headers={})
+
+	@staticmethod
+	def __trackIndexes(items) -> list:
+		import spotipy
+
+		try:
+			return [trackIndex(item) for item in items]
+		except ValueError as ex:
+			raise spotipy.SpotifyException(400, -1, str(ex), headers={})
+
+	def __playlist(self, playlist_id: str, write: bool = False) -> dict:
+		""" Find a playlist. Followed playlists of other users (with an "owner") can't be written to. """
+		import spotipy
+
+		for playlist in self.account.playlists:
+			if playlist["id"] == playlist_id:
+				if write and playlist.get("owner", self.account.user["id"]) != self.account.user["id"]:
+					raise spotipy.SpotifyException(403, -1, "Forbidden", headers={})
+				return playlist
+		raise spotipy.SpotifyException(404, -1, "Not found", headers={})
+
+	@staticmethod
+	def __snapshot(playlist: dict) -> str:
+		return f"{playlist['id']}-{playlist['version']}"
+
+	@staticmethod
+	def __page(items: list, total: int, limit: int, offset: int) -> dict:
+		return {
+			"items": items,
+			"total": total,
+			"limit": limit,
+			"offset": offset,
+			"next": "next" if offset + limit < total else None,
+			"previous": "previous" if offset else None
+		}
+
+	def me(self) -> dict:
+		return self.__request("me", lambda: dict(self.account.user))
+
+	def current_user_playlists(self, limit: int = 50, offset: int = 0) -> dict:
+		self.__checkLimit(limit, 50)
+		def result():
+			playlists = self.account.playlists
+			return self.__page([
+				{
+					"id": playlist["id"],
+					"name": playlist["name"],
+					"snapshot_id": self.__snapshot(playlist),
+					"owner": {"id": playlist.get("owner", self.account.user["id"])},
+					"tracks": {"total": len(playlist["tracks"])}
+				} for playlist in playlists[offset:offset + limit]
+			], len(playlists), limit, offset)
+		return self.__request("current_user_playlists", result)
+
+	def playlist_items(self, playlist_id: str, fields: str = None, limit: int = 100, offset: int = 0,
+			market: str = None, additional_types = ("track", "episode")) -> dict:
+		""" Items carry the fields of SBT_LowAPI.PLAYLIST_ITEM_FIELDS, `fields` itself isn't parsed. """
+		self.__checkLimit(limit, 100)
+		def result():
+			playlist = self.__playlist(playlist_id)
+			entries = range(offset, min(offset + limit, len(playlist["tracks"])))
+			return self.__page([
+				{"added_at": timestamp(playlist["added"][pos]), "track": self.account.track(playlist["tracks"][pos])}
+				for pos in entries
+			], len(playlist["tracks"]), limit, offset)
+		return self.__request("playlist_items", result)
+
+	def current_user_saved_tracks(self, limit: int = 20, offset: int = 0, market: str = None) -> dict:
+		self.__checkLimit(limit, 50)
+		def result():
+			library = self.account.library
+			added = self.account.library_added
+			last = len(library) - 1
+			return self.__page([
+				{"added_at": timestamp(added[last - pos]), "track": self.account.track(library[last - pos])}
+				for pos in range(offset, min(offset + limit, len(library)))
+			], len(library), limit, offset)
+		return self.__request("current_user_saved_tracks", result)
+
+	def user_playlist_create(self, user: str, name: str, public: bool = True, collaborative: bool = False,
+			description: str = "") -> dict:
+		def result():
+			playlist = {
+				"id": f"{self._rng.getrandbits(128):032x}"[:22],
 				"name": name,
-				#"explicit": explicit,
-				#"duration": duration
+				"version": 1,
+				"tracks": array("I"),
+				"added": array("d")
 			}
+			self.account.playlists.append(playlist)
+			return {"id": playlist["id"], "name": name, "snapshot_id": self.__snapshot(playlist)}
+		return self.__request("user_playlist_create", result)
+
+	def playlist_change_details(self, playlist_id: str, name: str = None, **kwargs):
+		def result():
+			playlist = self.__playlist(playlist_id, write=True)
+			if name is not None:
+				playlist["name"] = name
+		return self.__request("playlist_change_details", result)
+
+	def playlist_add_items(self, playlist_id: str, items: list, position: int = None) -> dict:
+		self.__checkLimit(len(items), 100)
+		indexes = self.__trackIndexes(items)
+		def result():
+			playlist = self.__playlist(playlist_id, write=True)
+			added = now()
+			playlist["tracks"].extend(indexes)
+			playlist["added"].extend(added for _ in indexes)
+			playlist["version"] += 1
+			return {"snapshot_id": self.__snapshot(playlist)}
+		return self.__request("playlist_add_items", result)
+
+	def playlist_remove_all_occurrences_of_items(self, playlist_id: str, items: list, snapshot_id: str = None) -> dict:
+		self.__checkLimit(len(items), 100)
+		indexes = set(self.__trackIndexes(items))
+		def result():
+			playlist = self.__playlist(playlist_id, write=True)
+			keep = [pos for pos, index in enumerate(playlist["tracks"]) if index not in indexes]
+			playlist["tracks"] = array("I", (playlist["tracks"][pos] for pos in keep))
+			playlist["added"] = array("d", (playlist["added"][pos] for pos in keep))
+			playlist["version"] += 1
+			return {"snapshot_id": self.__snapshot(playlist)}
+		return self.__request("playlist_remove_all_occurrences_of_items", result)
+
+	def current_user_saved_tracks_add(self, tracks: list = None):
+		self.__checkLimit(len(tracks), 50)
+		indexes = self.__trackIndexes(tracks)
+		def result():
+			saved = set(self.account.library)
+			added = max(now(), self.account.library_added[-1] if self.account.library_added else 0)
+			# Stored oldest first, so the first track of the batch ends up on top
+			for index in reversed(indexes):
+				if index not in saved:
+					saved.add(index)
+					self.account.library.append(index)
+					self.account.library_added.append(added)
+		return self.__request("current_user_saved_tracks_add", result)
+
+	def current_user_saved_tracks_delete(self, tracks: list = None):
+		self.__checkLimit(len(tracks), 50)
+		indexes = set(self.__trackIndexes(tracks))
+		def result():
+			keep = [pos for pos, index in enumerate(self.account.library) if index not in indexes]
+			self.account.library = array("I", (self.account.library[pos] for pos in keep))
+			self.account.library_added = array("d", (self.account.library_added[pos] for pos in keep))
+		return self.__request("current_user_saved_tracks_delete", result)
+
+class SBT_LowAPI(sbt_lowapi.SBT_LowAPI):
+	""" The real backend, talking to a synthetic account instead of Spotify.
+	Paging, fan-out, rate limiting and retries all run exactly like they do online.
 
-	def getSavedTracks(self) -> tuple:
-		tracks = list()
-		for track in self.iterSavedTracks(limit=20):
-			tracks.append(track)
-		return tuple(tracks)
+	Without an `account`, a small one is generated from the client ID. The remaining keyword
+	arguments (`latency`, `rate_limit`, `window`, `error_rate`) are passed to SBT_FakeSpotify. """
+
+	def __init__(self, client_id: str, redirect_uri=sbt_lowapi.SBT_LowAPI.DEF_REDIRECT_URI, limiter=None,
+			connections=None, *, account: SBT_FakeAccount = None, **server) -> None:
+		self.account = account or SBT_FakeAccount(seed=client_id)
+		self._server = server
+		super().__init__(client_id, redirect_uri, limiter=limiter, connections=connections)
+
+	def _client(self, redirect_uri: str) -> SBT_FakeSpotify:
+		self.auth_manager = None
+		return SBT_FakeSpotify(self.account, seed=self.client_id, **self._server)
+
+	def __repr__(self):
+		return f"<SBT_FakeAPI user=\"{self.display_name}\" account={self.account!r}>"
+
+	def getTransferStats(self) -> dict:
+		""" Like SBT_LowAPI.getTransferStats(), plus throttled and failed requests and calls per endpoint. """
+		with self.spotify._lock:
+			stats = {
+				"requests": self.spotify.stats["requests"],
+				"bytes": self.spotify.stats["bytes"],
+				"throttled": self.spotify.stats["throttled"],
+				"errors": self.spotify.stats["errors"],
+				"calls": dict(self.spotify.calls)
+			}
+		stats["bytes_per_request"] = stats["bytes"] / stats["requests"] if stats["requests"] else 0
+		return stats
 
 
 if __name__ == "__main__":
 	print("Test mode")
-	sbt = SBT_LowAPI("abcdefgh1234567890")
-	print(sbt)
\ No newline at end of file
+	sbt = SBT_LowAPI("abcdefgh1234567890", latency=0.01)
+	playlists = sbt.getPlaylists()
+	library = sbt.getSavedTracks()
+	print(sbt)
+	print(f"{len(playlists)} playlists, {len(library)} saved tracks")
+	print(sbt.getTransferStats())
@@ -0,0 +1,465 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+# system + builtin
+from datetime import datetime, timedelta
+from os.path  import abspath, basename, dirname, join
+from random   import randrange
+import codecs
+import json
+import mmap
+import os
+import io
+# lzma and gzip are imported on first use
+
+BACKUP_VERSION = 2.0
+
+MAGIC_LZMA = b"\xfd7zXZ\x00"
+MAGIC_GZIP = b"\x1f\x8b"
+
+# How long an incrementally synced library may go without a full fetch
+LIBRARY_SYNC_MAX_AGE = timedelta(days=7)
+
+def obfuscateAccount(account_id: str, mode: str) -> str:
+	""" Hide parts of an account ID. `mode` is one of "None", "Simple", "Static" or "Extreme". """
+	acct = list(account_id)
+
+	if mode == "Simple":
+		for _ in range(6):
+			pos = randrange(0, len(acct))
+			acct[pos] = "*"
+	elif mode == "Static":
+		sums = tuple(map(int, acct))
+		sums = zip(sums[::2], sums[1::2])
+		sums = map(sum, sums)
+		positions = map(lambda n: n % len(acct), set(sums))
+
+		for pos in positions:
+			acct[pos] = "*"
+	elif mode == "Extreme":
+		skip = (0, len(acct) - 1, len(acct) // 2)
+		for pos in range(len(acct)):
+			if pos not in skip:
+				acct[pos] = "*"
+	return "".join(acct)
+
+def backupHeader(account: str = None, library_synced: str = None) -> dict:
+	""" Return the "sbt" header of a new backup. """
+	return {
+		"version": BACKUP_VERSION,
+		"creation": str(datetime.now()),
+		"account": account,
+		"library_synced": library_synced
+	}
+
+def trackRecord(pos: int, track: dict, added_at: bool = False) -> dict:
+	""" Return the backup record of a track as returned by the backend. """
+	record = {
+		"pos": pos,
+		"name": track["name"],
+		"album": track["album"],
+		"artist": track["artist"],
+		"id": track["id"]
+	}
+	if added_at:
+		record["added_at"] = track["added_at"]
+	return record
+
+def detectCompression(path: str) -> str:
+	""" Return the compression of a .sbt file ("LZMA" or "GZIP") from its magic bytes, or None. """
+	with open(path, "rb") as backup:
+		magic = backup.read(len(MAGIC_LZMA))
+
+	if magic.startswith(MAGIC_LZMA):
+		return "LZMA"
+	if magic.startswith(MAGIC_GZIP):
+		return "GZIP"
+	return None
+
+def loadBackup(path: str) -> dict:
+	""" Load a whole .sbt backup file, decompressing it if needed.
+	Use SBT_BackupReader to go through large backups without loading them. """
+	compression = detectCompression(path)
+	if compression == "LZMA":
+		import lzma
+		backup = lzma.open(path, "rb")
+	elif compression == "GZIP":
+		import gzip
+		backup = gzip.open(path, "rb")
+	else:
+		backup = open(path, "rb")
+
+	with backup:
+		return json.load(backup)
+
+def backupPlaylists(backup: dict) -> dict:
+	""" Map playlist IDs to their entries in a loaded backup. """
+	return {playlist["id"]: playlist for playlist in (backup["playlists"] or {}).values()}
+
+def backupLibrary(backup: dict, max_age: timedelta = LIBRARY_SYNC_MAX_AGE):
+	""" Return the library of a loaded backup if it can be used as a base for an incremental sync.
+	Returns None if the backup holds a partial library or its last full sync is older than `max_age`. """
+	synced = backup["sbt"].get("library_synced")
+	if not synced or not backup["library"]:
+		return None
+	if datetime.now() - datetime.fromisoformat(synced) > max_age:
+		return None
+	return backup["library"]
+
+class SBT_BackupWriter:
+	""" Streams a backup into a .sbt file, one playlist at a time.
+
+	The file is written to a temporary file next to `path` and renamed over it only once
+	the backup was written completely, so a failed export never leaves a truncated file.
+	Sections must be written in order: the library first, then the playlists.
+
+		with SBT_BackupWriter(path, header, compression="LZMA") as writer:
+			writer.writeLibrary(tracks)
+			writer.writePlaylist(name, {"id": ...}, tracks)
+	"""
+
+	def __init__(self, path: str, header: dict, *, prettify: bool = True, compression: str = None):
+		self.path = abspath(path)
+		self.header = header
+		self.indent = 4 if prettify else 0
+		self.compression = compression
+		self._library_written = False
+		self._playlists_written = 0
+
+	def __enter__(self):
+		# Created like a plain open() would create the backup, so the umask applies to it
+		while True:
+			try:
+				self._tmp = open(join(dirname(self.path), f".{basename(self.path)}.{randrange(1 << 32):08x}.tmp"), "xb")
+				break
+			except FileExistsError:
+				continue
+		if self.compression == "LZMA":
+			import lzma
+			self._stream = lzma.open(self._tmp, "wb")
+		elif self.compression == "GZIP":
+			import gzip
+			self._stream = gzip.GzipFile(fileobj=self._tmp, mode="wb")
+		else:
+			self._stream = self._tmp
+		self._text = io.TextIOWrapper(self._stream, encoding="utf-8", newline="\n", write_through=False)
+
+		self._write("{" + self._newline(1) + "\"sbt\": " + self._dump(self.header, 1))
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		try:
+			if exc_type is None:
+				self._finish()
+			self._text.close() # Closes the compressor and the temporary file too
+			if self._stream is not self._tmp:
+				self._tmp.close()
+		except BaseException:
+			os.unlink(self._tmp.name)
+			raise
+
+		if exc_type is not None:
+			os.unlink(self._tmp.name)
+			return False
+		# Keep the permissions of the backup being replaced
+		try:
+			os.chmod(self._tmp.name, os.stat(self.path).st_mode & 0o7777)
+		except FileNotFoundError:
+			pass
+		os.replace(self._tmp.name, self.path)
+		return False
+
+	def _newline(self, level: int) -> str:
+		return "\n" + " " * (self.indent * level)
+
+	def _dump(self, value, level: int) -> str:
+		return json.dumps(value, indent=self.indent).replace("\n", self._newline(level))
+
+	def _write(self, data: str):
+		self._text.write(data)
+
+	def _writeArray(self, items, level: int):
+		self._write("[")
+		first = True
+		for item in items:
+			self._write(("" if first else ",") + self._newline(level + 1) + self._dump(item, level + 1))
+			first = False
+		self._write("]" if first else self._newline(level) + "]")
+
+	def writeLibrary(self, tracks):
+		""" Write the Liked Songs section. `tracks` may be any iterable, or None to leave it out. """
+		assert not self._library_written, "Library was already written"
+		self._write("," + self._newline(1) + "\"library\": ")
+		if tracks is None:
+			self._write("null")
+		else:
+			self._writeArray(tracks, 1)
+		self._library_written = True
+
+	def writePlaylist(self, name: str, info: dict, tracks):
+		""" Write a playlist. `info` holds its metadata, `tracks` may be any iterable. """
+		if not self._library_written:
+			self.writeLibrary(None)
+
+		if self._playlists_written == 0:
+			self._write("," + self._newline(1) + "\"playlists\": {")
+		else:
+			self._write(",")
+		self._write(self._newline(2) + json.dumps(name) + ": {")
+		for key, value in info.items():
+			self._write(self._newline(3) + json.dumps(key) + ": " + self._dump(value, 3) + ",")
+		self._write(self._newline(3) + "\"tracks\": ")
+		self._writeArray(tracks, 3)
+		self._write(self._newline(2) + "}")
+		self._playlists_written += 1
+
+	def _finish(self):
+		if not self._library_written:
+			self.writeLibrary(None)
+		if self._playlists_written == 0:
+			self._write("," + self._newline(1) + "\"playlists\": null")
+		else:
+			self._write(self._newline(1) + "}")
+		self._write(self._newline(0) + "}")
+		self._text.flush()
+		self._stream.flush()
+		if self._stream is not self._tmp:
+			# Let the compressor write its trailer before syncing
+			self._stream.close()
+		self._tmp.flush()
+		os.fsync(self._tmp.fileno())
+
+class _SBT_Scanner:
+	""" Decodes JSON values one at a time from a stream of byte chunks. """
+
+	WHITESPACE = " \t\r\n"
+
+	def __init__(self, chunks):
+		self._chunks = iter(chunks)
+		self._decoder = codecs.getincrementaldecoder("utf-8")()
+		self._json = json.JSONDecoder()
+		self.buf = ""
+		self.pos = 0
+		self.eof = False
+
+	def _fill(self) -> bool:
+		""" Append the next chunk to the buffer, dropping what was already consumed. """
+		if self.eof:
+			return False
+		chunk = next(self._chunks, None)
+		if chunk is None:
+			self.eof = True
+			text = self._decoder.decode(b"", final=True)
+		else:
+			text = self._decoder.decode(chunk)
+		self.buf = self.buf[self.pos:] + text
+		self.pos = 0
+		return True
+
+	def peek(self) -> str:
+		""" Return the next non-whitespace character without consuming it, "" at the end. """
+		while True:
+			while self.pos < len(self.buf) and self.buf[self.pos] in self.WHITESPACE:
+				self.pos += 1
+			if self.pos < len(self.buf):
+				return self.buf[self.pos]
+			if not self._fill():
+				return ""
+
+	def expect(self, chars: str) -> str:
+		char = self.peek()
+		if char == "" or char not in chars:
+			raise ValueError(f"Corrupt backup file: expected one of {chars!r}, found {char!r}")
+		self.pos += 1
+		return char
+
+	def value(self):
+		""" Decode the next complete JSON value. """
+		self.peek()
+		while True:
+			try:
+				value, end = self._json.raw_decode(self.buf, self.pos)
+			except json.JSONDecodeError:
+				if not self._fill():
+					raise
+				continue
+			if end == len(self.buf) and self._fill():
+				# A number may continue in the next chunk
+				continue
+			self.pos = end
+			return value
+
+class SBT_BackupReader:
+	""" Reads a .sbt backup file incrementally, without loading the whole document.
+
+	The compression is detected from the file's magic bytes, plain files are memory-mapped.
+	Sections can only be read in file order: the header is read on open, then the library,
+	then the playlists. Whatever is not consumed is skipped when moving on.
+
+		with SBT_BackupReader(path) as reader:
+			print(reader.header)
+			for track in reader.iterLibrary():
+				...
+			for name, playlist in reader.iterPlaylists():
+				for track in playlist["tracks"]:
+					...
+	"""
+
+	CHUNK_SIZE = 1 << 16
+
+	def __init__(self, path: str):
+		self.path = path
+		self.compression = detectCompression(path)
+		self.header = None
+		self._active = None
+
+	def __repr__(self):
+		return f"<SBT_BackupReader path=\"{self.path}\" compression={self.compression}>"
+
+	def __enter__(self):
+		self._file = open(self.path, "rb")
+		self._map = None
+		self._stream = None
+
+		if self.compression == "LZMA":
+			import lzma
+			self._stream = lzma.open(self._file, "rb")
+		elif self.compression == "GZIP":
+			import gzip
+			self._stream = gzip.GzipFile(fileobj=self._file, mode="rb")
+
+		if self._stream is not None:
+			chunks = iter(lambda: self._stream.read(self.CHUNK_SIZE), b"")
+		else:
+			try:
+				self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# Empty files can't be mapped
+				self._map = b""
+			chunks = (self._map[start:start + self.CHUNK_SIZE] for start in range(0, len(self._map), self.CHUNK_SIZE))
+
+		self._scan = _SBT_Scanner(chunks)
+		self._top = self._keys()
+		if self._seek("sbt"):
+			self.header = self._scan.value()
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		self._active = None
+		self._top = None
+		self._scan = None
+		if isinstance(self._map, mmap.mmap):
+			self._map.close()
+		if self._stream is not None:
+			self._stream.close()
+		self._file.close()
+		return False
+
+	def _keys(self):
+		""" Yield the keys of the object at the cursor, the caller consumes each value. """
+		self._scan.expect("{")
+		if self._scan.peek() == "}":
+			self._scan.pos += 1
+			return
+		while True:
+			key = self._scan.value()
+			self._scan.expect(":")
+			yield key
+			if self._scan.expect(",}") == "}":
+				return
+
+	def _array(self):
+		""" Yield the items of the array at the cursor, null is treated as an empty array. """
+		if self._scan.peek() == "n":
+			self._scan.value()
+			return
+		self._scan.expect("[")
+		if self._scan.peek() == "]":
+			self._scan.pos += 1
+			return
+		while True:
+			yield self._scan.value()
+			if self._scan.expect(",]") == "]":
+				return
+
+	def _skipValue(self):
+		char = self._scan.peek()
+		if char == "[":
+			for _ in self._array():
+				pass
+		elif char == "{":
+			for _ in self._keys():
+				self._skipValue()
+		else:
+			self._scan.value()
+
+	def _seek(self, key: str) -> bool:
+		""" Move the cursor to the value of a top-level key, skipping everything before it. """
+		for found in self._top:
+			if found == key:
+				return True
+			self._skipValue()
+		return False
+
+	def _drain(self):
+		if self._active is not None:
+			for _ in self._active:
+				pass
+			self._active = None
+
+	def _iterLibrary(self):
+		if self._seek("library"):
+			yield from self._array()
+
+	def _iterPlaylists(self):
+		if not self._seek("playlists"):
+			return
+		if self._scan.peek() == "n":
+			self._scan.value()
+			return
+
+		for name in self._keys():
+			playlist = dict()
+			tracks = iter(())
+			keys = self._keys()
+			for key in keys:
+				if key == "tracks":
+					tracks = self._array()
+					break
+				playlist[key] = self._scan.value()
+			playlist["tracks"] = tracks
+
+			yield name, playlist
+
+			for _ in tracks:
+				pass
+			# Keys after the track list can't be handed out anymore
+			for _ in keys:
+				self._skipValue()
+
+	def iterLibrary(self):
+		""" Yield the tracks of the backed up Liked Songs. """
+		self._drain()
+		self._active = self._iterLibrary()
+		return self._active
+
+	def iterPlaylists(self):
+		""" Yield (name, playlist) pairs. The "tracks" of each playlist is an iterator,
+		valid only until the next playlist is requested. """
+		self._drain()
+		self._active = self._iterPlaylists()
+		return self._active
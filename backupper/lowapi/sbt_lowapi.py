@@ -16,12 +16,175 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>
 
 # system + builtin
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib         import nullcontext
+from os.path            import expanduser
+import threading
 import json
 
-# external - Spotify
-from spotipy.oauth2 import SpotifyOAuth, SpotifyPKCE
-import spotipy
+# SBT backend
+from .sbt_ratelimit import SBT_RateLimiter
+
+class SBT_Cancelled(Exception):
+	""" Raised by a request made after the backend's operation was cancelled. """
+
+def trackInfo(item: dict, sep=", ") -> dict:
+	""" Convert a saved track or playlist item of the Web API to the track dict used by backups. """
+	track = item["track"]
+	return {
+		"id": track["id"],
+		"name": track["name"],
+		"album": track["album"]["name"],
+		"artist": sep.join(artist["name"] for artist in track["artists"]),
+		"added_at": item["added_at"]
+	}
+
+def baseTracks(playlist: dict, base: dict):
+	""" Return the tracks of `playlist` from a previous backup if it is unchanged since.
+	Playlist records in backups have no `added_at`, it's None in the returned tracks. """
+	previous = base.get(playlist["id"])
+	if previous is None or previous.get("snapshot_id") != playlist["snapshot_id"]:
+		return None
+	if len(previous["tracks"]) != playlist["track_count"]:
+		# Some tracks were left out of the previous backup
+		return None
+	return tuple(
+		{
+			"id": track["id"],
+			"name": track["name"],
+			"album": track["album"],
+			"artist": track["artist"],
+			"added_at": track.get("added_at")
+		}
+		for track in previous["tracks"]
+	)
+
+def playlistInfo(playlist: dict) -> dict:
+	""" Convert a playlist object of the Web API to the playlist dict used by the backends, without tracks. """
+	return {
+		"name": playlist["name"],
+		"id": playlist["id"],
+		"snapshot_id": playlist["snapshot_id"],
+		"track_count": playlist["tracks"]["total"],
+		# Followed playlists of other users are listed too
+		"owner": playlist["owner"]["id"]
+	}
+
+def createdPlaylist(response: dict, name: str, owner: str) -> dict:
+	""" Playlist dict of a playlist `owner` just created, from the response of the create request. """
+	return {"name": name, "id": response["id"], "snapshot_id": response["snapshot_id"], "track_count": 0, "owner": owner}
+
+def applyBase(playlists, base: dict) -> tuple:
+	""" Copy the tracks of every playlist unchanged since the `base` backup (see baseTracks()).
+	Returns the playlists whose tracks must be fetched and the number of tracks copied. """
+	changed = list()
+	track_count = 0
+	for playlist in playlists:
+		tracks = baseTracks(playlist, base) if base else None
+		if tracks is None:
+			changed.append(playlist)
+		else:
+			playlist["tracks"] = tracks
+			track_count += len(tracks)
+	return changed, track_count
+
+class SBT_PlaylistIndex:
+	""" Playlist name -> IDs and ID -> metadata of an account's playlists. """
+
+	def __init__(self, playlists = ()):
+		self._names = dict()
+		self._meta = dict()
+		for playlist in playlists:
+			self.add(playlist)
+
+	def __repr__(self):
+		return f"<SBT_PlaylistIndex playlists={len(self._meta)}>"
+
+	def add(self, playlist: dict):
+		self._names.setdefault(playlist["name"], []).append(playlist["id"])
+		self._meta[playlist["id"]] = {key: value for key, value in playlist.items() if key != "tracks"}
+
+	def names(self) -> tuple:
+		return tuple(self._names.keys())
+
+	def ids(self, name: str, owner: str = None) -> tuple:
+		""" Return the IDs of the playlists called `name`, only those owned by `owner` if given. """
+		ids = self._names.get(name, ())
+		if owner is not None:
+			ids = (playlist_id for playlist_id in ids if self._meta[playlist_id]["owner"] == owner)
+		return tuple(ids)
+
+	def info(self, playlist_id: str) -> dict:
+		if playlist_id not in self._meta:
+			raise Exception("Could not find playlist")
+		return self._meta[playlist_id]
+
+	def rename(self, playlist_id: str, name: str) -> bool:
+		""" Returns False if the playlist isn't indexed. """
+		if playlist_id not in self._meta:
+			return False
+		info = self._meta[playlist_id]
+		ids = self._names[info["name"]]
+		ids.remove(playlist_id)
+		if len(ids) == 0:
+			del self._names[info["name"]]
+		info["name"] = name
+		self._names.setdefault(name, []).append(playlist_id)
+		return True
+
+class SBT_LibraryMerge:
+	""" Merges newly saved tracks onto the library of a previous backup, see SBT_LowAPI.getSavedTracks().
+	Feed it saved tracks newest first until add() returns False. """
+
+	def __init__(self, base: list):
+		self.anchor = base[0]
+		self.previous = [{key: value for key, value in track.items() if key != "pos"} for track in base]
+		self.tracks = list()
+
+	def add(self, track: dict) -> bool:
+		""" Add a saved track, returns False once the rest is known from the base. """
+		if track["id"] == self.anchor["id"] and track["added_at"] == self.anchor["added_at"]:
+			return False
+		if track["added_at"] < self.anchor["added_at"]:
+			# The newest track of the previous backup was removed since
+			self.previous = self.previous[1:]
+			return False
+		self.tracks.append(track)
+		return True
+
+	def result(self) -> tuple:
+		return tuple(self.tracks + self.previous)
+
+# client ID -> token cache, see tokenCache()
+_token_caches = dict()
+_token_caches_lock = threading.Lock()
+
+def tokenCache(client_id: str, path: str):
+	""" Return the spotipy cache handler of `client_id`, shared by every backend of that client ID.
+	The cache file is read once, the token is then served from memory and written back when it's refreshed. """
+	from spotipy.cache_handler import CacheFileHandler
+
+	class SBT_TokenCache(CacheFileHandler):
+		def __init__(self, cache_path: str):
+			super().__init__(cache_path=cache_path)
+			self.token_info = super().get_cached_token()
+
+		def get_cached_token(self):
+			return self.token_info
+
+		def save_token_to_cache(self, token_info):
+			self.token_info = token_info
+			super().save_token_to_cache(token_info)
+
+	with _token_caches_lock:
+		if client_id not in _token_caches:
+			_token_caches[client_id] = SBT_TokenCache(path)
+		return _token_caches[client_id]
+
+def batches(items, size: int):
+	items = list(items)
+	for start in range(0, len(items), size):
+		yield items[start:start + size]
 
 class SBT_LowAPI:
 	DEF_REDIRECT_URI = "http://localhost:8888/callback"
@@ -33,18 +196,67 @@ class SBT_LowAPI:
 		"playlist-read-private",
 		"playlist-modify-public"
 	)
+	DEF_WORKERS      = 4
+	MAX_RETRIES      = 5
+	DEF_FANOUT       = 8
+	# Largest page size accepted by each paged endpoint
+	PAGE_LIMITS      = {
+		"playlists":      50,
+		"playlist_items": 100,
+		"saved_tracks":   50
+	}
+	# Largest number of tracks accepted by each write endpoint
+	WRITE_LIMITS     = {
+		"playlist_add":    100,
+		"playlist_remove": 100,
+		"library_save":    50,
+		"library_remove":  50
+	}
+	# Only request the track fields we actually read
+	PLAYLIST_ITEM_FIELDS = "items(added_at,track(id,name,album(name),artists(name))),total,limit,offset,next"
+	DEF_MARKET       = "from_token"
+	# Cached tokens are kept per client ID, so that several accounts can be used side by side
+	TOKEN_CACHE_PATH = "~/.sbt_token-{client_id}"
 
-	def __init__(self, client_id: str, redirect_uri=DEF_REDIRECT_URI) -> None:
+	def __init__(self, client_id: str, redirect_uri=DEF_REDIRECT_URI, limiter: SBT_RateLimiter = None,
+			connections: threading.Semaphore = None) -> None:
+		""" `limiter` is the rate limit budget of this backend, a new one is created if not given.
+		`connections` is an optional semaphore shared between backends, bounding the requests in flight across all of them. """
 		self.client_id = client_id
+		self.limiter = limiter or SBT_RateLimiter()
+		self.connections = connections or nullcontext()
+		self.spotify = self._client(redirect_uri)
+
+		self._stats = {"requests": 0, "bytes": 0}
+		self._stats_lock = threading.Lock()
+
+		# Set from another thread to abort the running operation
+		self.cancelled = threading.Event()
+
+		# Built on first lookup
+		self._playlist_index = None
+		self._index_lock = threading.Lock()
+
+		# Trigger auth
+		self.usercache = self.__call(self.spotify.me)
+
+	def _client(self, redirect_uri: str):
+		""" Create the Spotify client all requests are made through. """
+		# external - Spotify, imported here so that importing the backend stays cheap
+		from spotipy.oauth2 import SpotifyPKCE
+		import requests
+		import spotipy
+
 		self.auth_manager = SpotifyPKCE(
 			client_id=self.client_id,
 			redirect_uri=redirect_uri,
-			scope=" ".join(self.DEF_SCOPES)
+			scope=" ".join(self.DEF_SCOPES),
+			cache_handler=tokenCache(self.client_id, expanduser(self.TOKEN_CACHE_PATH.format(client_id=self.client_id)))
 		)
-		self.spotify = spotipy.Spotify(auth_manager=self.auth_manager)
-
-		# Trigger auth
-		self.usercache = self.spotify.me()
+		# Use a plain session so that throttled requests are retried by us, not by spotipy
+		session = requests.Session()
+		session.hooks["response"].append(self.__countResponse)
+		return spotipy.Spotify(auth_manager=self.auth_manager, requests_session=session)
 
 	def __repr__(self):
 		return f"<SBT_LowAPI user=\"{self.display_name}\">"
@@ -69,89 +281,230 @@ class SBT_LowAPI:
 	def user_picture(self) -> str:
 		return self.usercache["images"][0]["url"]
 
-	def __getPagedItem(self, func, **kwargs):
-		offset = 0
-		data = func(**kwargs)
-		
-		while len(data["items"]) != 0:
-			yield from data["items"]
+	def __countResponse(self, response, *args, **kwargs):
+		with self._stats_lock:
+			self._stats["requests"] += 1
+			self._stats["bytes"] += len(response.content)
 
-			offset += len(data["items"])
-			data = func(**kwargs, offset=offset)
+	def getTransferStats(self) -> dict:
+		""" Return the number of responses and (decompressed) bytes received so far. """
+		with self._stats_lock:
+			stats = dict(self._stats)
+		stats["bytes_per_request"] = stats["bytes"] / stats["requests"] if stats["requests"] else 0
+		return stats
+
+	def __call(self, func, *, idempotent: bool = True, **kwargs):
+		""" Call an API function through the rate limiter.
+		Throttled (429) and failed (5xx) requests are retried, honoring Retry-After.
+		Requests that are not `idempotent` (adding playlist items, creating a playlist) may have been applied
+		when they time out or fail with 5xx, those errors are raised instead. Only 429 is retried for them. """
+		import requests
+		import spotipy
 
-	def __getArtists(self, track: list, sep=", ") -> str:
-		return sep.join(artist["name"] for artist in track["artists"])
+		for attempt in range(self.MAX_RETRIES + 1):
+			self.limiter.acquire()
+			if self.cancelled.is_set():
+				raise SBT_Cancelled()
+			try:
+				with self.connections:
+					result = func(**kwargs)
+			except spotipy.SpotifyException as ex:
+				if attempt == self.MAX_RETRIES or not (ex.http_status == 429 or (idempotent and ex.http_status >= 500)):
+					raise
+				retry_after = (getattr(ex, "headers", None) or {}).get("Retry-After")
+				self.limiter.throttled(float(retry_after) if retry_after else None)
+			except (requests.ConnectionError, requests.Timeout):
+				if attempt == self.MAX_RETRIES or not idempotent:
+					raise
+				self.limiter.throttled()
+			else:
+				self.limiter.success()
+				return result
 
-	def __track_yield(self, src: dict) -> dict:
-		for track in src:
-			id_ = track["track"]["id"]
-			name = track["track"]["name"]
-			album = track["track"]["album"]["name"]
-			artist = self.__getArtists(track["track"])
+	def __getPagedItem(self, func, endpoint: str, *, limit: int = None, fanout: bool = False, **kwargs):
+		""" Yield every item of a paged endpoint.
+		Pages are as large as `endpoint` allows unless a smaller `limit` is given.
+		With `fanout`, the remaining pages are requested concurrently once the
+		first page reports the total, and are yielded back in order. """
+		max_limit = self.PAGE_LIMITS[endpoint]
+		kwargs["limit"] = min(limit, max_limit) if limit else max_limit
+		data = self.__call(func, **kwargs)
+		yield from data["items"]
 
-			yield {
-				"id": id_,
-				"name": name,
-				"album": album,
-				"artist": artist
-			}
+		offset = data.get("offset", 0) + len(data["items"])
+		if fanout and data.get("total") is not None and data.get("limit"):
+			pool = ThreadPoolExecutor(max_workers=self.DEF_FANOUT)
+			try:
+				pages = pool.map(
+					lambda page_offset: self.__call(func, **kwargs, offset=page_offset),
+					range(offset, data["total"], data["limit"])
+				)
+				for page in pages:
+					yield from page["items"]
+			finally:
+				pool.shutdown(cancel_futures=True)
+			return
 
-	def iterPlaylists(self, *, limit: int = 1):
-		for playlist in self.__getPagedItem(self.spotify.current_user_playlists, limit=limit):
-			name = playlist["name"]
-			id_ = playlist["id"]
-			tracks = self.iterPlaylistTracks(id_)
+		while data.get("next") and len(data["items"]) != 0:
+			data = self.__call(func, **kwargs, offset=offset)
+			yield from data["items"]
+			offset += len(data["items"])
 
-			yield {"name": name, "id": id_, "tracks": tracks}
+	def iterPlaylists(self, *, limit: int = None):
+		for playlist in self.__getPagedItem(self.spotify.current_user_playlists, "playlists", limit=limit):
+			info = playlistInfo(playlist)
+			info["tracks"] = self.iterPlaylistTracks(info["id"])
+			yield info
 
 	def iterPlaylistNames(self):
 		yield from (
-			playlist["name"] for playlist in self.__getPagedItem(self.spotify.current_user_playlists, limit=1)
+			playlist["name"] for playlist in self.__getPagedItem(self.spotify.current_user_playlists, "playlists")
 		)
 
-	def iterPlaylistTracks(self, playlist_id: str, *, limit: int = 1):
+	def iterPlaylistTracks(self, playlist_id: str, *, limit: int = None, fanout: bool = False):
 		getter = self.__getPagedItem(
-			self.spotify.user_playlist_tracks,
+			self.spotify.playlist_items,
+			"playlist_items",
+			fanout = fanout,
 			playlist_id = playlist_id,
+			fields = self.PLAYLIST_ITEM_FIELDS,
+			market = self.DEF_MARKET,
+			additional_types = ("track",),
 			limit = limit
 		)
-		yield from self.__track_yield(getter)
+		yield from map(trackInfo, getter)
 
 	def getPlaylistTracks(self, playlist_id: str) -> tuple:
 		results = list()
-		for result in self.iterPlaylistTracks(playlist_id, limit=100):
+		for result in self.iterPlaylistTracks(playlist_id, fanout=True):
 			results.append(result)
 		return tuple(results)
 
-	def getPlaylists(self, delay: int = 1) -> tuple:
-		playlists = list()
-		for playlist in self.iterPlaylists(limit=50):
-			playlist["tracks"] = self.getPlaylistTracks(playlist["id"])
-			playlists.append(playlist)
-			sleep(delay)
-		return tuple(playlists)
+	def getPlaylists(self, workers: int = DEF_WORKERS, base: dict = None, progress = None) -> tuple:
+		""" Fetch every playlist with its tracks, `workers` playlists at a time.
+		Requests are paced by the shared rate limiter, the order of playlists is kept.
+
+		`base` maps playlist IDs to their entries in a previous backup (see sbt_file.backupPlaylists).
+		Playlists whose snapshot did not change since are copied from it without fetching any tracks.
+
+		`progress(done, total, tracks)` is called with the number of playlists and tracks fetched so far. """
+		playlists = tuple(self.iterPlaylists())
+		with self._index_lock:
+			self._playlist_index = SBT_PlaylistIndex(playlists)
+
+		changed, track_count = applyBase(playlists, base)
+		done = len(playlists) - len(changed)
+		if progress:
+			progress(done, len(playlists), track_count)
+
+		with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+			results = pool.map(lambda playlist: self.getPlaylistTracks(playlist["id"]), changed)
+			for playlist, tracks in zip(changed, results):
+				playlist["tracks"] = tracks
+				done += 1
+				track_count += len(tracks)
+				if progress:
+					progress(done, len(playlists), track_count)
+		return playlists
+
+	def __playlistIndex(self) -> SBT_PlaylistIndex:
+		""" Return the playlist index, listing the account's playlists once if needed. """
+		with self._index_lock:
+			if self._playlist_index is None:
+				self._playlist_index = SBT_PlaylistIndex(self.iterPlaylists())
+			return self._playlist_index
+
+	def invalidatePlaylistIndex(self):
+		""" Drop the playlist index, it will be rebuilt on the next lookup. """
+		with self._index_lock:
+			self._playlist_index = None
 
 	def getPlaylistNames(self):
-		return tuple(self.iterPlaylistNames())
+		return self.__playlistIndex().names()
+
+	def getPlaylistIDs(self, playlist_name, owner: str = None) -> tuple:
+		""" Return the IDs of every playlist called `playlist_name`, only those owned by `owner` if given. """
+		return self.__playlistIndex().ids(playlist_name, owner)
 
 	def getPlaylistID(self, playlist_name):
-		for playlist in self.iterPlaylists(limit=50):
-			if playlist["name"] == playlist_name:
-				return playlist["id"]
-		raise Exception("Could not find playlist")
+		ids = self.getPlaylistIDs(playlist_name)
+		if len(ids) == 0:
+			raise Exception("Could not find playlist")
+		return ids[0]
+
+	def getPlaylistInfo(self, playlist_id) -> dict:
+		return self.__playlistIndex().info(playlist_id)
+
+	def createPlaylist(self, name: str, public: bool = False, description: str = "") -> str:
+		""" Create a new playlist and return its ID. """
+		playlist = self.__call(
+			self.spotify.user_playlist_create,
+			idempotent = False,
+			user = self.id,
+			name = name,
+			public = public,
+			description = description
+		)
+		with self._index_lock:
+			if self._playlist_index is not None:
+				self._playlist_index.add(createdPlaylist(playlist, name, self.id))
+		return playlist["id"]
 
-	def iterSavedTracks(self, *, limit: int = 1):
+	def renamePlaylist(self, playlist_id: str, name: str):
+		self.__call(self.spotify.playlist_change_details, playlist_id=playlist_id, name=name)
+		with self._index_lock:
+			if self._playlist_index is not None and not self._playlist_index.rename(playlist_id, name):
+				# Not ours or not indexed yet, rebuild on the next lookup
+				self._playlist_index = None
+
+	def iterSavedTracks(self, *, limit: int = None, fanout: bool = False):
 		getter = self.__getPagedItem(
 			self.spotify.current_user_saved_tracks,
+			"saved_tracks",
+			fanout = fanout,
+			market = self.DEF_MARKET,
 			limit = limit
 		)
-		yield from self.__track_yield(getter)
+		yield from map(trackInfo, getter)
+
+	def addPlaylistTracks(self, playlist_id: str, track_ids):
+		""" Append tracks to a playlist, in order, as few requests as possible.
+		A batch that fails after it may have been added is not sent again, the error is raised
+		and a differential restore (see SBT_Restore) sends what is still missing. """
+		for batch in batches(track_ids, self.WRITE_LIMITS["playlist_add"]):
+			self.__call(self.spotify.playlist_add_items, playlist_id=playlist_id, items=batch, idempotent=False)
+
+	def saveTracks(self, track_ids):
+		""" Add tracks to Liked Songs, as few requests as possible. Pass the oldest tracks first.
+		The first track of a request ends up on top, so batches are sent oldest first
+		with the tracks inside each batch newest first. """
+		for batch in batches(track_ids, self.WRITE_LIMITS["library_save"]):
+			self.__call(self.spotify.current_user_saved_tracks_add, tracks=batch[::-1])
+
+	def removePlaylistTracks(self, playlist_id: str, track_ids):
+		""" Remove every occurrence of the given tracks from a playlist. """
+		for batch in batches(track_ids, self.WRITE_LIMITS["playlist_remove"]):
+			self.__call(self.spotify.playlist_remove_all_occurrences_of_items, playlist_id=playlist_id, items=batch)
+
+	def unsaveTracks(self, track_ids):
+		""" Remove tracks from Liked Songs. """
+		for batch in batches(track_ids, self.WRITE_LIMITS["library_remove"]):
+			self.__call(self.spotify.current_user_saved_tracks_delete, tracks=batch)
+
+	def getSavedTracks(self, base: list = None) -> tuple:
+		""" Fetch Liked Songs, newest first.
+
+		`base` is the library of a previous backup (see sbt_file.backupLibrary). If given, saved tracks
+		are only paged through until the newest track of `base` is reached, and the new ones are
+		merged onto it. Tracks removed since are only noticed by a full fetch. """
+		if not base:
+			return tuple(self.iterSavedTracks(fanout=True))
 
-	def getSavedTracks(self) -> tuple:
-		tracks = list()
-		for track in self.iterSavedTracks(limit=20):
-			tracks.append(track)
-		return tuple(tracks)
+		merge = SBT_LibraryMerge(base)
+		for track in self.iterSavedTracks():
+			if not merge.add(track):
+				break
+		return merge.result()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+# system + builtin
+from time import monotonic, sleep
+from random import uniform
+import threading
+
+class SBT_RateLimiter:
+	""" Adaptive token bucket shared by every request made through a backend.
+
+	The rate is cut in half whenever the API throttles us and probed back up
+	towards the target rate on every successful request. """
+
+	DEF_RATE     = 10.0	# target requests per second
+	DEF_BURST    = 10
+	MIN_RATE     = 0.5
+	PROBE_STEP   = 0.25	# rate increase per successful request
+	BACKOFF_BASE = 1.0	# seconds
+	BACKOFF_MAX  = 60.0
+
+	def __init__(self, rate: float = DEF_RATE, burst: int = DEF_BURST) -> None:
+		self.target = rate
+		self.rate = rate
+		self.burst = burst
+		self._tokens = float(burst)
+		self._stamp = monotonic()
+		self._resume = 0.0
+		self._failures = 0
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return f"<SBT_RateLimiter rate={self.rate:.2f}/{self.target:.2f}/s burst={self.burst}>"
+
+	def _refill(self, now: float):
+		self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+		self._stamp = now
+
+	def _reserve(self) -> float:
+		""" Take a token if one is available, otherwise return how long to wait before trying again. """
+		with self._lock:
+			now = monotonic()
+			if now < self._resume:
+				return self._resume - now
+			self._refill(max(now, self._stamp))
+			if self._tokens >= 1:
+				self._tokens -= 1
+				return 0.0
+			return (1 - self._tokens) / self.rate
+
+	def acquire(self):
+		""" Block until a request may be sent. """
+		while (wait := self._reserve()) > 0:
+			sleep(wait)
+
+	async def acquireAsync(self):
+		""" Like acquire(), but waits without blocking the event loop.
+		Sync and async backends can share one limiter. """
+		import asyncio
+
+		while (wait := self._reserve()) > 0:
+			await asyncio.sleep(wait)
+
+	def success(self):
+		""" Report a successful request, probing the rate back up towards the target. """
+		with self._lock:
+			self._failures = 0
+			self.rate = min(self.target, self.rate + self.PROBE_STEP)
+
+	def throttled(self, retry_after: float = None):
+		""" Report a throttled (429) or failed (5xx) request.
+		Pauses every caller for `retry_after` seconds if the server told us to,
+		otherwise for an exponential backoff with jitter. """
+		with self._lock:
+			self._failures += 1
+			self.rate = max(self.MIN_RATE, self.rate / 2)
+
+			if retry_after is None:
+				delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** (self._failures - 1))
+				delay = uniform(delay / 2, delay)
+			else:
+				delay = retry_after + uniform(0, self.BACKOFF_BASE)
+
+			now = monotonic()
+			self._resume = max(self._resume, now + delay)
+			self._tokens = 0.0
+			self._stamp = self._resume
@@ -0,0 +1,239 @@
+# Copyright (C) 2022 Fábián Varga
+#
+# This file is part of Spotify Backup Tool.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+# system + builtin
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses        import dataclass, field
+from collections        import Counter
+
+# SBT backend
+from .sbt_file import SBT_BackupReader
+
+@dataclass
+class SBT_RestorePlan:
+	""" Operations needed to bring an account in line with a backup. """
+	library_add: list = field(default_factory=list)
+	library_remove: list = field(default_factory=list)
+	# One entry per backed up playlist: {"name", "id" (None if it has to be created), "add", "remove"}
+	playlists: list = field(default_factory=list)
+
+	@property
+	def empty(self) -> bool:
+		return not (self.library_add or self.library_remove or any(
+			playlist["id"] is None or playlist["add"] or playlist["remove"] for playlist in self.playlists
+		))
+
+	def summary(self) -> str:
+		created = [playlist for playlist in self.playlists if playlist["id"] is None]
+		changed = [playlist for playlist in self.playlists if playlist["id"] and (playlist["add"] or playlist["remove"])]
+		lines = [
+			f"Liked Songs: +{len(self.library_add)} -{len(self.library_remove)}",
+			f"Playlists to create: {len(created)} ({sum(len(playlist['add']) for playlist in created)} tracks)",
+			f"Playlists to update: {len(changed)}"
+		]
+		for playlist in changed:
+			lines.append(f"  {playlist['name']}: +{len(playlist['add'])} -{len(playlist['remove'])}")
+		lines.append(f"Playlists up to date: {len(self.playlists) - len(created) - len(changed)}")
+		return "\n".join(lines)
+
+	def __str__(self):
+		return self.summary()
+
+class SBT_Restore:
+	""" Brings the account behind a backend in line with a backup.
+
+	`backup` is either a loaded backup or an open SBT_BackupReader, which keeps
+	only track IDs in memory while planning.
+
+	The target account is read first and only the tracks missing from it are sent (see `plan()`),
+	so re-running a restore after a partial failure costs almost nothing.
+	Tracks are added in the largest batches the API accepts, in their original `pos` order.
+	Playlists are processed concurrently, all requests share the backend's rate limiter. """
+
+	DEF_WORKERS = 4
+
+	def __init__(self, lowapi, backup, workers: int = DEF_WORKERS) -> None:
+		self.lowapi = lowapi
+		self.backup = backup
+		self.workers = workers
+
+	def __repr__(self):
+		return f"<SBT_Restore target={self.lowapi!r}>"
+
+	@staticmethod
+	def _trackIDs(tracks) -> list:
+		""" Return the IDs of tracks sorted by their position, skipping local tracks. """
+		ordered = sorted((track["pos"], track["id"]) for track in tracks if track["id"])
+		return [track_id for _, track_id in ordered]
+
+	def _library(self):
+		if isinstance(self.backup, SBT_BackupReader):
+			return self.backup.iterLibrary()
+		return self.backup["library"] or ()
+
+	def _playlists(self):
+		if isinstance(self.backup, SBT_BackupReader):
+			return self.backup.iterPlaylists()
+		return (self.backup["playlists"] or {}).items()
+
+	@staticmethod
+	def _missing(wanted: list, present) -> list:
+		""" Return the entries of `wanted` not in `present`, keeping order and duplicates. """
+		available = Counter(present)
+		missing = list()
+		for track_id in wanted:
+			if available[track_id] > 0:
+				available[track_id] -= 1
+			else:
+				missing.append(track_id)
+		return missing
+
+	def _targets(self, playlists: list) -> list:
+		""" Pick the target playlist of every backed up (name, id) pair, None if it has to be created.
+
+		Followed playlists of other users can't be written to, only our own are used. A playlist whose
+		backed up ID we still own is restored into itself, the other playlists of the same name get the
+		remaining ones in order. No target is used twice, so playlists sharing a name stay separate. """
+		owned = {name: self.lowapi.getPlaylistIDs(name, owner=self.lowapi.id) for name, _ in playlists}
+		targets = [None] * len(playlists)
+		used = set()
+		for i, (name, playlist_id) in enumerate(playlists):
+			if playlist_id in owned[name] and playlist_id not in used:
+				targets[i] = playlist_id
+				used.add(playlist_id)
+		for i, (name, _) in enumerate(playlists):
+			if targets[i] is None:
+				targets[i] = next((playlist_id for playlist_id in owned[name] if playlist_id not in used), None)
+				used.add(targets[i])
+		return targets
+
+	def _planPlaylist(self, name: str, playlist_id: str, wanted: list, remove: bool) -> dict:
+		if playlist_id is None:
+			return {"name": name, "id": None, "add": wanted, "remove": []}
+
+		present = [track["id"] for track in self.lowapi.getPlaylistTracks(playlist_id) if track["id"]]
+		wanted_set = set(wanted)
+		return {
+			"name": name,
+			"id": playlist_id,
+			"add": self._missing(wanted, present),
+			"remove": sorted(set(present) - wanted_set) if remove else []
+		}
+
+	def plan(self, remove: bool = False) -> SBT_RestorePlan:
+		""" Read the target account and compute the minimal set of changes.
+		With `remove`, tracks missing from the backup are removed from the account too. """
+		plan = SBT_RestorePlan()
+
+		wanted = self._trackIDs(self._library())
+		if wanted:
+			present = set(track["id"] for track in self.lowapi.iterSavedTracks(fanout=True))
+			# Liked Songs are listed newest first, saveTracks() takes the oldest ones first
+			plan.library_add = [track_id for track_id in reversed(wanted) if track_id not in present]
+			if remove:
+				plan.library_remove = sorted(present - set(wanted))
+
+		# Track IDs are collected in file order here, only the target account is read concurrently
+		playlists = [
+			(name, playlist.get("id"), self._trackIDs(playlist["tracks"])) for name, playlist in self._playlists()
+		]
+		targets = self._targets([(name, playlist_id) for name, playlist_id, _ in playlists])
+		with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+			plan.playlists = list(pool.map(
+				lambda playlist, target: self._planPlaylist(playlist[0], target, playlist[2], remove), playlists, targets
+			))
+		return plan
+
+	def _applyPlaylist(self, playlist: dict, playlist_id: str) -> int:
+		self.lowapi.removePlaylistTracks(playlist_id, playlist["remove"])
+		self.lowapi.addPlaylistTracks(playlist_id, playlist["add"])
+		return len(playlist["add"])
+
+	def apply(self, plan: SBT_RestorePlan) -> dict:
+		""" Carry out a plan, returns the number of tracks added per section. """
+		self.lowapi.unsaveTracks(plan.library_remove)
+		self.lowapi.saveTracks(plan.library_add)
+		# Created one by one in backup order, so playlists sharing a name are matched the same way next time
+		playlist_ids = [playlist["id"] or self.lowapi.createPlaylist(playlist["name"]) for playlist in plan.playlists]
+		with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+			added = sum(pool.map(self._applyPlaylist, plan.playlists, playlist_ids))
+		return {
+			"library": len(plan.library_add),
+			"playlists": added
+		}
+
+	def run(self, remove: bool = False, report = print) -> dict:
+		""" Plan and restore the whole backup, returns the number of tracks added per section.
+		The plan summary is passed to `report` before anything is changed. """
+		plan = self.plan(remove)
+		if report:
+			report(plan.summary())
+		return self.apply(plan)
+
+
+if __name__ == "__main__":
+	# For debugging only! Back up a synthetic account, restore it into an empty one and read it back.
+	# Run it from the `backupper` directory: `python -m lowapi.sbt_restore`
+	from .sbt_fakeapi import SBT_LowAPI, SBT_FakeAccount
+	from .sbt_file    import trackRecord
+
+	source = SBT_LowAPI("source", account=SBT_FakeAccount(1, playlists=5, tracks=600, library=300))
+	library = source.getSavedTracks()
+	playlists = source.getPlaylists()
+	backup = {
+		"library": [trackRecord(i + 1, track, added_at=True) for i, track in enumerate(library)],
+		"playlists": {
+			playlist["name"]: {"id": playlist["id"], "tracks": [trackRecord(i + 1, track) for i, track in enumerate(playlist["tracks"])]}
+			for playlist in playlists
+		}
+	}
+
+	target = SBT_LowAPI("target", account=SBT_FakeAccount(1, 0, 0, 0))
+	# A followed playlist of another user with the name of a backed up one, which must be left alone
+	followed = SBT_FakeAccount(2, playlists=1, tracks=10, library=0).playlists[0]
+	followed.update(name=playlists[0]["name"], owner="someone")
+	target.account.playlists.append(followed)
+	print(SBT_Restore(target, backup).run())
+	assert len(followed["tracks"]) == 10, "Restored into a followed playlist"
+	assert [track["id"] for track in target.getSavedTracks()] == [track["id"] for track in library], "Liked Songs out of order"
+	for playlist in playlists:
+		restored = target.getPlaylistTracks(target.getPlaylistIDs(playlist["name"], owner=target.id)[0])
+		assert [track["id"] for track in restored] == [track["id"] for track in playlist["tracks"]], f"{playlist['name']} out of order"
+	print("Restored in order.")
+
+	# Playlists sharing a name must each be restored into a playlist of their own, also when restoring again.
+	# Only a streamed backup keeps both of them, a loaded one is a dict keyed by name.
+	import tempfile, os
+	from array    import array
+	from .sbt_file import SBT_BackupWriter, SBT_BackupReader, backupHeader
+
+	source = SBT_LowAPI("source", account=SBT_FakeAccount(3, playlists=2, tracks=40, library=0))
+	source.account.playlists[1].update(name=source.account.playlists[0]["name"], tracks=array("I"), added=[])
+	playlists = source.getPlaylists()
+	path = os.path.join(tempfile.mkdtemp(), "duplicates.sbt")
+	with SBT_BackupWriter(path, backupHeader()) as writer:
+		for playlist in playlists:
+			writer.writePlaylist(playlist["name"], {"id": playlist["id"]}, (trackRecord(i + 1, track) for i, track in enumerate(playlist["tracks"])))
+
+	target = SBT_LowAPI("target", account=SBT_FakeAccount(3, 0, 0, 0))
+	for remove in (False, True):
+		with SBT_BackupReader(path) as reader:
+			SBT_Restore(target, reader).run(remove=remove)
+		restored = [target.getPlaylistTracks(playlist_id) for playlist_id in target.getPlaylistIDs(playlists[0]["name"])]
+		assert [len(tracks) for tracks in restored] == [len(playlist["tracks"]) for playlist in playlists], "Playlists sharing a name were mixed up"
+	os.unlink(path)
+	print("Kept playlists sharing a name apart.")